@@ -25,7 +25,7 @@ setup(
     packages = find_packages(exclude=['*.tests*']),
     package_data = {
         'tracexceldownload': [
-            'locale/*.*', 'locale/*/LC_MESSAGES/*.mo',
+            'locale/*.*', 'locale/*/LC_MESSAGES/*.mo', 'templates/*.html',
         ],
     },
     test_suite = 'tracexceldownload.tests.suite',
@@ -34,6 +34,8 @@ setup(
     entry_points = {
         'trac.plugins': [
             'tracexceldownload.api = tracexceldownload.api',
+            'tracexceldownload.cache = tracexceldownload.cache',
+            'tracexceldownload.job = tracexceldownload.job',
             'tracexceldownload.ticket = tracexceldownload.ticket',
             'tracexceldownload.translation = tracexceldownload.translation',
         ],
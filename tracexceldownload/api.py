@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import atexit
 import inspect
+import os
 import re
 import sys
+import threading
+import time
+import zlib
+from bisect import bisect_right
 from cStringIO import StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
+from uuid import uuid4
+from tempfile import SpooledTemporaryFile, TemporaryFile
 from unicodedata import east_asian_width
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 try:
     import openpyxl
 except ImportError:
@@ -17,34 +26,50 @@ except ImportError:
     xlwt = None
 
 from trac.core import Component, TracError
-from trac.util.text import to_unicode
-from tracexceldownload.translation import ChoiceOption, N_, ngettext
+from trac.db.api import DatabaseManager
+from trac.db.util import ConnectionWrapper, IterableCursor
+from trac.perm import PermissionSystem
+from trac.util.datefmt import utc
+from trac.util.text import exception_to_unicode, to_unicode
+from trac.web.api import RequestDone
+from trac.web.wsgi import _FileWrapper
+from tracexceldownload.translation import (BoolOption, ChoiceOption,
+                                           IntOption, N_, ngettext)
 
 
-__all__ = ('get_excel_format', 'get_excel_mimetype', 'get_workbook_writer')
+__all__ = ('get_excel_format', 'get_excel_mimetype', 'get_server_cursor',
+           'get_workbook_writer', 'has_fine_grained_permissions',
+           'is_buffered_download', 'send_workbook', 'send_workbook_file')
 
 
 def get_excel_format(env):
+    return _writer_class(env).ext
+
+
+def _writer_class(env):
     format = ExcelDownloadConfig(env).format
     if format == '(auto)':
         if openpyxl:
-            return 'xlsx'
+            return OpenpyxlWorkbookWriter
         if xlwt:
-            return 'xls'
-        raise TracError("Require openpyxl or xlwt library")
+            return XlwtWorkbookWriter
+        return ZipfileWorkbookWriter
     if format == 'xlsx':
         if openpyxl:
-            return format
+            return OpenpyxlWorkbookWriter
         raise TracError("Require openpyxl library")
     if format == 'xls':
         if xlwt:
-            return format
+            return XlwtWorkbookWriter
         raise TracError("Require xlwt library")
+    if format == 'xlsx-builtin':
+        return ZipfileWorkbookWriter
     raise TracError("Unsupported format: '%s'" % format)
 
 
 def _writer(ext):
-    for cls in (OpenpyxlWorkbookWriter, XlwtWorkbookWriter):
+    for cls in (OpenpyxlWorkbookWriter, XlwtWorkbookWriter,
+                ZipfileWorkbookWriter):
         if cls.ext == ext:
             return cls
     raise TracError("Unsupported format '%s'" % ext)
@@ -55,11 +80,179 @@ def get_excel_mimetype(ext):
 
 
 def get_workbook_writer(env, req):
-    ext = get_excel_format(env)
-    cls = _writer(ext)
+    cls = _writer_class(env)
     return cls(env, req)
 
 
+def is_buffered_download(env):
+    return ExcelDownloadConfig(env).download_mode == 'buffered'
+
+
+def send_workbook(env, req, book, filename):
+    config = ExcelDownloadConfig(env)
+    mode = config.download_mode
+    req.send_response(200)
+    req.send_header('Content-Type', book.mimetype)
+    req.send_header('Content-Disposition', 'filename=%s' % filename)
+    if mode == 'chunked':
+        req.end_headers()
+        out = ResponseStream(req)
+        book.dump(out)
+        out.close()
+    elif mode == 'spooled':
+        max_size = max(config.spool_max_size, 1)
+        out = SpooledTemporaryFile(max_size=max_size)
+        book.dump(out)
+        _send_fileobj(req, out, out.tell(), max_size)
+    else:
+        content = book.dumps()
+        req.send_header('Content-Length', len(content))
+        req.end_headers()
+        req.write(content)
+    raise RequestDone
+
+
+def send_workbook_file(env, req, path, mimetype, filename):
+    """Send the Excel file previously written to `path`."""
+    req.send_response(200)
+    req.send_header('Content-Type', mimetype)
+    req.send_header('Content-Disposition', 'filename=%s' % filename)
+    fileobj = open(path, 'rb')
+    _send_fileobj(req, fileobj, os.fstat(fileobj.fileno()).st_size, 0)
+    raise RequestDone
+
+
+def _send_fileobj(req, fileobj, length, max_size):
+    """Send the content of the file object. Unless the content is small
+    enough, the file object is handed to `wsgi.file_wrapper` and closed
+    by the server after sending it."""
+    fileobj.seek(0)
+    req.send_header('Content-Length', length)
+    req.end_headers()
+    if req.method == 'HEAD':
+        fileobj.close()
+    elif length <= max_size:
+        content = fileobj.read()
+        fileobj.close()
+        req.write(content)
+    else:
+        file_wrapper = req.environ.get('wsgi.file_wrapper', _FileWrapper)
+        req._response = file_wrapper(fileobj, 65536)
+
+
+_REALM_WIDE_POLICIES = ('DefaultPermissionPolicy', 'DefaultWikiPolicy',
+                        'LegacyAttachmentPolicy', 'ReadonlyWikiPolicy')
+
+
+def has_fine_grained_permissions(env):
+    """Return `True` if a permission policy which may decide the
+    permissions of each ticket is enabled."""
+    return any(policy.__class__.__name__ not in _REALM_WIDE_POLICIES
+               for policy in PermissionSystem(env).policies)
+
+
+def get_server_cursor(env, db):
+    """Return a cursor fetching the rows of a query from the database
+    server in batches if `server_cursor` is enabled and the database is
+    PostgreSQL or MySQL. Otherwise, a cursor of `db` is returned. The
+    cursor must be closed after use.
+
+    A cursor for MySQL uses another connection, because no queries can
+    be executed on the connection while fetching the rows."""
+    config = ExcelDownloadConfig(env)
+    if config.server_cursor:
+        cnx = db
+        while isinstance(cnx, ConnectionWrapper):
+            cnx = cnx.cnx
+        module = type(cnx).__module__.split('.')[0]
+        size = max(config.server_cursor_fetch_size, 1)
+        if module == 'psycopg2':
+            cursor = cnx.cursor('tracexceldownload_%s' % uuid4().hex)
+            return ServerCursor(cursor, size, env.log)
+        if module == 'MySQLdb':
+            connector, args = DatabaseManager(env)._get_connector()
+            cnx = connector.get_connection(**args)
+            cursor = cnx.cnx.cursor(_mysql_server_cursor_class())
+            return ServerCursor(cursor, size, env.log, cnx.close)
+    return db.cursor()
+
+
+def _mysql_server_cursor_class():
+    global _MySQLServerCursor
+    if _MySQLServerCursor is None:
+        from MySQLdb.cursors import SSCursor
+
+        class _MySQLServerCursor(SSCursor):
+            def _convert_row(self, row):
+                return tuple(v.decode('utf-8') if isinstance(v, str) else v
+                             for v in row)
+
+            def fetchone(self):
+                row = SSCursor.fetchone(self)
+                return self._convert_row(row) if row else None
+
+            def fetchmany(self, size=None):
+                rows = SSCursor.fetchmany(self, size)
+                return [self._convert_row(row) for row in rows or ()]
+
+    return _MySQLServerCursor
+
+_MySQLServerCursor = None
+
+
+class ServerCursor(object):
+    """Wrap a server-side cursor to be used like a cursor of `db`, while
+    fetching the rows in batches of `size`."""
+
+    def __init__(self, cursor, size, log=None, close=None):
+        self.cursor = IterableCursor(cursor, log)
+        self.size = size
+        self._close = close
+        self._rows = []
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def execute(self, sql, args=None):
+        self.cursor.execute(sql, args)
+        # the description of a named cursor of psycopg2 is available after
+        # fetching the rows
+        self._rows = list(self.cursor.fetchmany(self.size))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = size or self.size
+        rows = self._rows
+        while len(rows) < size:
+            fetched = self.cursor.fetchmany(self.size)
+            if not fetched:
+                break
+            rows.extend(fetched)
+        self._rows = rows[size:]
+        return rows[:size]
+
+    def fetchall(self):
+        return list(self)
+
+    def close(self):
+        try:
+            self.cursor.close()
+        finally:
+            if self._close:
+                self._close()
+
+
 def _max_rows_error(num):
     message = ngettext(
         "Number of rows in the Excel sheet exceeded the limit of %(num)d row",
@@ -86,15 +279,330 @@ def _make_invalid_chars_re():
     return re.compile(pattern)
 
 
+class _LRUCache(object):
+    """Mapping which keeps about the `size` most recently used items.
+
+    The items are kept in two generations of plain dicts, the recently
+    used items are moved to the current generation and the previous
+    generation is dropped when the current one is full.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._current = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self._current.get(key)
+        if value is None:
+            value = self._previous.get(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            current = self._current
+            if len(current) >= self.size // 2:
+                self._previous = current
+                self._current = current = {}
+            current[key] = value
+
+
+def _make_wide_chars_re(ambiwidth, start, stop):
+    # build a character class from the ranges of the double-width
+    # characters instead of calling east_asian_width for each character
+    doubles = ('WFA', 'WF')[ambiwidth == 1]
+    ranges = []
+    low = None
+    for code in xrange(start, stop):
+        if east_asian_width(unichr(code)) in doubles:
+            if low is None:
+                low = code
+        elif low is not None:
+            ranges.append((low, code - 1))
+            low = None
+    if low is not None:
+        ranges.append((low, stop - 1))
+    if not ranges:
+        return None
+    pattern = u'[' + \
+              u''.join(u'%s-%s' % (unichr(low), unichr(high))
+                       for low, high in ranges) + u']'
+    return re.compile(pattern, re.UNICODE)
+
+
+def _get_wide_chars_findall(ambiwidth, astral):
+    # the characters beyond BMP are matched by the separated pattern
+    # because the character class including them is much slower
+    key = (ambiwidth, astral)
+    if key not in _wide_chars_findall:
+        if astral:
+            start, stop = 0x10000, sys.maxunicode + 1
+        else:
+            start, stop = 0x80, min(0x10000, sys.maxunicode + 1)
+        wide_chars_re = _make_wide_chars_re(ambiwidth, start, stop)
+        _wide_chars_findall[key] = wide_chars_re and wide_chars_re.findall
+    return _wide_chars_findall[key]
+
+
+_wide_chars_findall = {}
+_astral_chars_re = re.compile(u'[\U00010000-\U0010ffff]'
+                              if sys.maxunicode >= 0x10000 else u'(?!)')
+_metrics_cache = _LRUCache(10000)
+
+
+def _get_text_metrics(value, ambiwidth):
+    """Return the width and the number of lines of unicode `value`."""
+    short = len(value) <= 64
+    if short:
+        key = (value, ambiwidth)
+        metrics = _metrics_cache.get(key)
+        if metrics is not None:
+            return metrics
+    lines = value.splitlines()
+    try:
+        # no double-width characters in ASCII and, unless the ambiguous
+        # characters are double-width, in Latin-1
+        value.encode(('latin-1', 'ascii')[ambiwidth != 1])
+    except UnicodeEncodeError:
+        findalls = [_get_wide_chars_findall(ambiwidth, False)]
+        if _astral_chars_re.search(value):
+            findalls.append(_get_wide_chars_findall(ambiwidth, True))
+        findalls = filter(None, findalls)
+        width = max(len(line) + sum(len(findall(line))
+                                    for findall in findalls)
+                    for line in lines)
+    else:
+        width = max(len(line) for line in lines)
+    metrics = (width, len(lines))
+    if short:
+        _metrics_cache.set(key, metrics)
+    return metrics
+
+
+_epoc = datetime(1970, 1, 1, tzinfo=utc)
+_naive_epoc = datetime(1970, 1, 1)
+_tz_transitions = {}
+
+
+def _get_tz_transitions(tz):
+    # the transitions of pytz timezone in microseconds since epoch and the
+    # offsets in seconds
+    try:
+        return _tz_transitions[tz]
+    except KeyError:
+        pass
+    times = getattr(tz, '_utc_transition_times', None)
+    infos = getattr(tz, '_transition_info', None)
+    if not times or not infos:
+        transitions = None
+    else:
+        def to_us(t):
+            t = t - _naive_epoc
+            return (t.days * 86400 + t.seconds) * 1000000 + t.microseconds
+        def to_secs(offset):
+            return offset.days * 86400 + offset.seconds
+        transitions = ([to_us(t) for t in times],
+                       [to_secs(info[0]) for info in infos])
+    _tz_transitions[tz] = transitions
+    return transitions
+
+
+class _TimezoneConverter(object):
+    """Convert aware datetimes or microsecond timestamps to the local time
+    in `tz` without creating an aware datetime for each value.
+
+    The UTC offsets are looked up in the transitions of pytz timezone, or
+    are computed once per 15 minutes for the other timezones.
+    """
+
+    _bucket = 15 * 60 * 1000000
+
+    def __init__(self, tz):
+        self.tz = tz
+        transitions = _get_tz_transitions(tz)
+        if transitions:
+            self._times, self._offsets = transitions
+        else:
+            self._times = self._offsets = None
+        self._bucket_offsets = {}
+
+    def to_datetime(self, value):
+        """Return the naive local datetime truncated to seconds."""
+        return _naive_epoc + timedelta(seconds=self._to_local(value))
+
+    def to_serial(self, value):
+        """Return the serial number of Excel's 1900 date system."""
+        # 2209161600 seconds from 1899-12-30 to 1970-01-01
+        days, secs = divmod(self._to_local(value) + 2209161600, 86400)
+        return days + secs / 86400.0
+
+    def _to_local(self, value):
+        # local seconds since epoch
+        if isinstance(value, datetime):
+            value = value - _epoc
+            value = (value.days * 86400 + value.seconds) * 1000000 + \
+                    value.microseconds
+        if self._times:
+            offset = self._offsets[bisect_right(self._times, value) - 1]
+        else:
+            bucket = value // self._bucket
+            offset = self._bucket_offsets.get(bucket)
+            if offset is None:
+                offset = self._get_offset(bucket * self._bucket)
+                self._bucket_offsets[bucket] = offset
+        return value // 1000000 + offset
+
+    def _get_offset(self, ts):
+        t = (_epoc + timedelta(microseconds=ts)).astimezone(self.tz)
+        if hasattr(self.tz, 'normalize'):  # pytz
+            t = self.tz.normalize(t)
+        offset = t.utcoffset()
+        return offset.days * 86400 + offset.seconds
+
+
 class ExcelDownloadConfig(Component):
 
-    format = ChoiceOption('exceldownload', 'format', ('(auto)', 'xlsx', 'xls'),
-        doc=N_("Specifies the format of Excel file to download."))
+    format = ChoiceOption('exceldownload', 'format',
+                          ('(auto)', 'xlsx', 'xls', 'xlsx-builtin'),
+        doc=N_("Specifies the format of Excel file to download. "
+               "`xlsx` and `xls` require openpyxl and xlwt library. "
+               "`xlsx-builtin` generates xlsx format without any library."))
+
+    download_mode = ChoiceOption(
+        'exceldownload', 'download_mode', ('buffered', 'chunked', 'spooled'),
+        doc=N_("Specifies how the Excel file is sent to the client. "
+               "`buffered` builds the entire file in memory and sends it "
+               "with `Content-Length` header. `chunked` sends the file in "
+               "chunks while it is being written, without `Content-Length` "
+               "header. `spooled` writes the file to a temporary file and "
+               "sends it using `wsgi.file_wrapper` of the web server."))
+
+    spool_max_size = IntOption(
+        'exceldownload', 'spool_max_size', 1048576,
+        doc=N_("Maximum size in bytes of the Excel file kept in memory "
+               "when `download_mode` is `spooled`. Larger files are moved "
+               "to a temporary file on disk."))
+
+    width_sample_rows = IntOption(
+        'exceldownload', 'width_sample_rows', 0,
+        doc=N_("Number of leading rows used to determine the column widths "
+               "of a sheet in xlsx format. After the rows, the rows are "
+               "written directly to the sheet without keeping them in "
+               "memory. If `0`, all rows are kept in memory until the "
+               "widths are determined from all rows. Setting a number "
+               "reduces the memory of large sheets, but the widths may be "
+               "narrower than the longer values of the following rows."))
+
+    report_mode = ChoiceOption(
+        'exceldownload', 'report_mode', ('rendered', 'direct'),
+        doc=N_("Specifies how reports are exported. `rendered` converts "
+               "the data rendered by the report module, except the reports "
+               "generated in background which are written like `direct`. "
+               "`direct` runs the SQL of the report and writes the rows to "
+               "the sheet while fetching them, except sorted reports which "
+               "are still rendered."))
+
+    server_cursor = BoolOption(
+        'exceldownload', 'server_cursor', 'disabled',
+        doc=N_("Enable to fetch the rows of queries and reports from the "
+               "database server while writing the Excel file, using named "
+               "cursors on PostgreSQL and unbuffered cursors on MySQL. "
+               "Other databases ignore the option."))
+
+    server_cursor_fetch_size = IntOption(
+        'exceldownload', 'server_cursor_fetch_size', 1000,
+        doc=N_("Number of rows fetched from the database server at once "
+               "when `server_cursor` is enabled."))
+
+    compression = ChoiceOption(
+        'exceldownload', 'compression',
+        ('auto', 'default', 'fast', 'best', 'store'),
+        doc=N_("Specifies the compression of Excel files in xlsx format. "
+               "`default`, `fast` and `best` compress with the default "
+               "level, level 1 and level 9 of deflate. `store` stores the "
+               "files without compression. `auto` compresses with the "
+               "default level, and with `fast` after the workbook has "
+               "more rows than `compression_auto_rows`. The `compression` "
+               "argument of the request overrides it for the Excel files "
+               "generated in background. The compression of xlsx with old "
+               "versions of openpyxl is always the default."))
+
+    compression_auto_rows = IntOption(
+        'exceldownload', 'compression_auto_rows', 100000,
+        doc=N_("Number of rows above which `auto` of `compression` "
+               "compresses with `fast`."))
+
+    compress_processes = IntOption(
+        'exceldownload', 'compress_processes', 0,
+        doc=N_("Number of processes which serialize and compress the rows "
+               "of the sheets in `xlsx-builtin` format, in order to not "
+               "hold the interpreter lock of the web server while "
+               "writing large Excel files. If `0`, the rows are "
+               "compressed in the thread writing the file. The other "
+               "formats ignore the option. The processes are started at "
+               "the first download and kept until the web server exits."))
+
+    concurrent_history = BoolOption(
+        'exceldownload', 'concurrent_history', 'disabled',
+        doc=N_("Enable to fetch the change history of the tickets in a "
+               "thread while the query sheet is written, when downloading "
+               "a query including history. An in-memory SQLite database "
+               "is always fetched in the request thread."))
+
+    fetch_batch_size = IntOption(
+        'exceldownload', 'fetch_batch_size', 1000,
+        doc=N_("Number of tickets fetched with their custom fields and "
+               "change history at once while writing the history sheet."))
 
 
 class WorksheetWriterError(TracError): pass
 
 
+class ResponseStream(object):
+    """Write-only file-like object which sends the written data to the
+    client in chunks."""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, req):
+        self.req = req
+        self._buf = []
+        self._bufsize = 0
+        self._pos = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self._buf.append(data)
+        self._bufsize += len(data)
+        self._pos += len(data)
+        if self._bufsize >= self.CHUNK_SIZE:
+            self._send()
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._send()
+
+    def _send(self):
+        if self._buf:
+            data = ''.join(self._buf)
+            self._buf[:] = ()
+            self._bufsize = 0
+            self.req.write(data)
+
+
+_compress_levels = {'default': zlib.Z_DEFAULT_COMPRESSION, 'fast': 1,
+                    'best': 9, 'store': None}
+
+
 class AbstractWorkbookWriter(object):
 
     ext = None
@@ -110,8 +618,33 @@ class AbstractWorkbookWriter(object):
         else:
             self.ambiwidth = 1
         self.book = book
+        config = ExcelDownloadConfig(env)
+        self.width_sample_rows = config.width_sample_rows
+        self.compression = config.compression
+        self.compression_auto_rows = config.compression_auto_rows
         self.styles = self._get_excel_styles()
-        self._metrics_cache = {}
+        self.sheets = []
+
+    @property
+    def rows_written(self):
+        return sum(sheet.row_idx for sheet in self.sheets)
+
+    def set_compression(self, compression):
+        """Override the compression of the workbook. Unknown values are
+        ignored."""
+        if compression == 'auto' or compression in _compress_levels:
+            self.compression = compression
+
+    def get_compress_level(self):
+        """Return the level of deflate for the rows written so far, or
+        `None` to store without compression."""
+        compression = self.compression
+        if compression == 'auto':
+            if self.rows_written > self.compression_auto_rows:
+                compression = 'fast'
+            else:
+                compression = 'default'
+        return _compress_levels[compression]
 
     def create_sheet(self, title):
         raise NotImplemented
@@ -124,7 +657,18 @@ class AbstractWorkbookWriter(object):
         self.dump(out)
         return out.getvalue()
 
+    _styles_cache = {}
+
     def _get_excel_styles(self):
+        # the styles are created once per process and engine
+        cls = self.__class__
+        styles = AbstractWorkbookWriter._styles_cache.get(cls)
+        if styles is None:
+            styles = self._create_excel_styles()
+            AbstractWorkbookWriter._styles_cache[cls] = styles
+        return styles
+
+    def _create_excel_styles(self):
         raise NotImplemented
 
     def get_metrics(self, value):
@@ -136,16 +680,7 @@ class AbstractWorkbookWriter(object):
             if value.is_integer():
                 value = int(value)
             value = to_unicode(str(value))
-        if value not in self._metrics_cache:
-            lines = value.splitlines()
-            doubles = ('WFA', 'WF')[self.ambiwidth == 1]
-            width = max(sum((1, 2)[east_asian_width(ch) in doubles]
-                            for ch in line)
-                        for line in lines)
-            if len(value) > 64:
-                return width, len(lines)
-            self._metrics_cache[value] = (width, len(lines))
-        return self._metrics_cache[value]
+        return _get_text_metrics(value, self.ambiwidth)
 
 
 class AbstractWorksheetWriter(object):
@@ -162,10 +697,104 @@ class AbstractWorksheetWriter(object):
         self.row_idx = 0
         self._col_widths = {}
         self.tz = writer.req.tz
+        self._tz_converter = _TimezoneConverter(self.tz)
+        writer.sheets.append(self)
 
     def write_row(self, cells):
+        convert_value = self._convert_value
+        resolve_style = self._resolve_style
+        values = []
+        for value, style, width, line in cells:
+            value, value_width, value_line = convert_value(value, style)
+            if value_width is not None:
+                width = value_width
+            if value_line is not None:
+                line = value_line
+            values.append((value, resolve_style(style), width, line))
+        self._write_cells(values)
+
+    def compile_columns(self, columns):
+        """Return the plan of the columns to write rows by `write_values`.
+        `columns` is a list of `(type, style)`. `type` is `'datetime'`,
+        `'timestamp'` for microseconds since epoch, `'number'`, `'text'` or
+        `None` to check the type of each value."""
+        return [self._compile_column(type, style) for type, style in columns]
+
+    def write_values(self, plan, values, changes=()):
+        """Write a row of `values` by the `plan` of the columns. The cells
+        in the column indexes of `changes` are written with the ':change'
+        styles."""
+        convert_value = self._convert_value
+        cells = []
+        for idx, value in enumerate(values):
+            types, convert, styles, other_styles = plan[idx]
+            if types and isinstance(value, types):
+                value, width, line = convert(value)
+            else:
+                value, width, line = convert_value(value, None)
+                styles = other_styles
+            cells.append((value, styles[idx in changes], width, line))
+        self._write_cells(cells)
+
+    def _compile_column(self, type, style):
+        resolve_style = self._resolve_style
+        styles = (resolve_style(style), resolve_style(style + ':change'))
+        if type in ('datetime', 'timestamp'):
+            convert_datetime = self._convert_datetime
+            width = self._get_date_width(style)
+            return (datetime if type == 'datetime' else (int, long),
+                    lambda value: (convert_datetime(value), width, 1),
+                    styles, (resolve_style('*'), resolve_style('*:change')))
+        if type == 'number':
+            ratio = self._width_ratio
+            return ((int, long, float, Decimal),
+                    lambda value: (value, len('%g' % value) / ratio, 1),
+                    styles, styles)
+        if type == 'text':
+            normalize_text = self._normalize_text
+            return (basestring,
+                    lambda value: (normalize_text(value), None, None),
+                    styles, styles)
+        return (None, None, styles, styles)
+
+    def _write_cells(self, cells):
         raise NotImplemented
 
+    _width_ratio = 1.2
+    _date_widths = {'[date]': len('YYYY-MM-DD'), '[time]': len('HH:MM:SS')}
+
+    def _convert_value(self, value, style):
+        if isinstance(value, datetime):
+            return (self._convert_datetime(value),
+                    self._get_date_width(style), 1)
+        if value is True or value is False:
+            return self._convert_bool(value)
+        if isinstance(value, (int, long, float, Decimal)):
+            return value, len('%g' % value) / self._width_ratio, 1
+        if isinstance(value, basestring):
+            return self._normalize_text(value), None, None
+        if value is not None:
+            return self._normalize_text(to_unicode(value)), None, None
+        return None, None, None
+
+    def _convert_datetime(self, value):
+        return self._tz_converter.to_datetime(value)
+
+    def _convert_bool(self, value):
+        return value, 5 / self._width_ratio, 1
+
+    def _get_date_width(self, style):
+        width = self._date_widths.get(style, len('YYYY-MM-DD HH:MM:SS'))
+        return width / self._width_ratio
+
+    def _resolve_style(self, style):
+        if style not in self.styles:
+            if style.endswith(':change'):
+                style = '*:change'
+            else:
+                style = '*'
+        return style
+
     def move_row(self):
         self.row_idx += 1
         if self.row_idx >= self.MAX_ROWS:
@@ -184,6 +813,7 @@ class AbstractWorksheetWriter(object):
         raise NotImplemented
 
     _invalid_chars_re = _make_invalid_chars_re()
+    _numeric_chars = frozenset(u'+-.iInN')
 
     def _normalize_text(self, value):
         if isinstance(value, str):
@@ -192,10 +822,15 @@ class AbstractWorksheetWriter(object):
         value = '\n'.join(line.rstrip() for line in value.splitlines())
         if len(value) > self.MAX_CHARS:
             value = value[:self.MAX_CHARS - 1] + u'\u2026'
-        try:
-            return float(value)
-        except:
-            return value
+        # try float() only if the text can be a number
+        first = value[:1]
+        if first.isdigit() or first.isspace() or \
+                first in self._numeric_chars:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        return value
 
 
 class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
@@ -211,15 +846,40 @@ class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
         AbstractWorkbookWriter.__init__(self, env, req, book)
         for style in self.styles.itervalues():
             book.add_named_style(style)
+        self._sheets = []
 
     def create_sheet(self, title):
         sheet = self.book.create_sheet(title=title)
-        return OpenpyxlWorksheetWriter(sheet, self)
+        writer = OpenpyxlWorksheetWriter(sheet, self)
+        self._sheets.append(writer)
+        return writer
 
     def dump(self, out):
-        self.book.save(out)
+        # flush the rows kept in the sheets which are not finished
+        for writer in self._sheets:
+            writer.set_col_widths()
+        ExcelWriter = _openpyxl_excel_writer()
+        if ExcelWriter:
+            # save with the archive compressing with the level
+            if not self.book.worksheets:
+                self.book.create_sheet()
+            archive = _ZipfileArchive(out, self.get_compress_level())
+            ExcelWriter(self.book, archive).save(None)
+        else:
+            self.book.save(out)
 
     def _get_excel_styles(self):
+        # NamedStyle is bound to a workbook, so the cached styles are
+        # copied with the shared font, fill, border and alignment
+        from openpyxl.styles import NamedStyle
+        styles = AbstractWorkbookWriter._get_excel_styles(self)
+        return dict((name, NamedStyle(name=name, font=style.font,
+                                      fill=style.fill, border=style.border,
+                                      alignment=style.alignment,
+                                      number_format=style.number_format))
+                    for name, style in styles.iteritems())
+
+    def _create_excel_styles(self):
         from openpyxl.styles import (
             Alignment, Border, Font, NamedStyle, PatternFill, Side)
 
@@ -310,6 +970,16 @@ class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
             return openpyxl.Workbook(optimized_write=True)
 
 
+def _openpyxl_excel_writer():
+    """Return `ExcelWriter` of openpyxl if it accepts the archive."""
+    try:
+        from openpyxl.writer.excel import ExcelWriter
+    except ImportError:
+        return None
+    if 'archive' in inspect.getargspec(ExcelWriter.__init__)[0]:
+        return ExcelWriter
+
+
 class OpenpyxlWorksheetWriter(AbstractWorksheetWriter):
 
     MAX_ROWS = 1048576
@@ -319,81 +989,65 @@ class OpenpyxlWorksheetWriter(AbstractWorksheetWriter):
     def __init__(self, sheet, writer):
         AbstractWorksheetWriter.__init__(self, sheet, writer)
         self._rows = []
-
-    def write_row(self, cells):
-        get_metrics = self.get_metrics
-        tz = self.tz
-        has_tz_normalize = hasattr(tz, 'normalize')  # pytz
-
-        values = []
-        for idx, (value, style, width, line) in enumerate(cells):
-            if isinstance(value, datetime):
-                value = value.astimezone(tz)
-                if has_tz_normalize:
-                    value = tz.normalize(value)
-                value = datetime(*(value.timetuple()[0:6]))
-                if style == '[date]':
-                    width = len('YYYY-MM-DD')
-                elif style == '[time]':
-                    width = len('HH:MM:SS')
-                else:
-                    width = len('YYYY-MM-DD HH:MM:SS')
-                width /= 1.2
-                line = 1
-            elif isinstance(value, (int, long, float, Decimal)):
-                width = len('%g' % value) / 1.2
-                line = 1
-            elif value is True or value is False:
-                width = 5 / 1.2
-                line = 1
-            elif isinstance(value, basestring):
-                value = self._normalize_text(value)
-
-            if width is None or line is None:
-                metrics = get_metrics(value)
-                if width is None:
-                    width = metrics[0]
-                if line is None:
-                    line = metrics[1]
-
-            cell = OpenpyxlCell(value)
-            if style not in self.styles:
-                if style.endswith(':change'):
-                    style = '*:change'
-                else:
-                    style = '*'
-            cell.style = style
-            values.append(cell)
-            self._set_col_width(idx, width)
-
-        self._rows.append(values or (None,))
+        self._sample_rows = max(writer.width_sample_rows, 0)
+        self._streaming = False
+
+    def _write_cells(self, cells):
+        if self._streaming:
+            values = [OpenpyxlCell(value, style)
+                      for value, style, width, line in cells]
+            self._append_row(values or (None,))
+        else:
+            get_metrics = self.get_metrics
+            values = []
+            for idx, (value, style, width, line) in enumerate(cells):
+                if width is None or line is None:
+                    metrics = get_metrics(value)
+                    if width is None:
+                        width = metrics[0]
+                    if line is None:
+                        line = metrics[1]
+                values.append(OpenpyxlCell(value, style))
+                self._set_col_width(idx, width)
+            self._rows.append(values or (None,))
+            if self._sample_rows and len(self._rows) >= self._sample_rows:
+                self._start_streaming()
         self.row_idx += 1
 
     def set_col_widths(self):
+        if not self._streaming:
+            self._start_streaming()
+
+    def _start_streaming(self):
         from openpyxl.utils.cell import get_column_letter
-        from openpyxl.cell import Cell
-        TYPE_STRING = Cell.TYPE_STRING
 
         for idx, width in sorted(self._col_widths.iteritems()):
             letter = get_column_letter(idx + 1)
             self.sheet.column_dimensions[letter].width = 1 + min(width, 50)
+        self._streaming = True
         for row in self._rows:
-            values = []
-            for val in row:
-                if val:
-                    value = val.value
-                    cell = Cell(self.sheet, column='A', row=1)
-                    if isinstance(value, basestring):
-                        cell.set_explicit_value(value, data_type=TYPE_STRING)
-                    else:
-                        cell.value = value
-                    cell.style = val.style
-                else:
-                    cell = val
-                values.append(cell)
-            self.sheet.append(values)
+            self._append_row(row)
         self._rows[:] = ()
 
+    def _append_row(self, row):
+        from openpyxl.cell import Cell
+        TYPE_STRING = Cell.TYPE_STRING
+
+        values = []
+        for val in row:
+            if val:
+                value = val.value
+                cell = Cell(self.sheet, column='A', row=1)
+                if isinstance(value, basestring):
+                    cell.set_explicit_value(value, data_type=TYPE_STRING)
+                else:
+                    cell.value = value
+                cell.style = val.style
+            else:
+                cell = val
+            values.append(cell)
+        self.sheet.append(values)
+
 
 class OpenpyxlCell(object):
 
@@ -422,7 +1076,7 @@ class XlwtWorkbookWriter(AbstractWorkbookWriter):
     def dump(self, out):
         self.book.save(out)
 
-    def _get_excel_styles(self):
+    def _create_excel_styles(self):
         Alignment = xlwt.Alignment
         SOLID_PATTERN = xlwt.Pattern.SOLID_PATTERN
         THIN = xlwt.Borders.THIN
@@ -524,41 +1178,16 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
         AbstractWorksheetWriter.move_row(self)
         self._flush_row()
 
-    def write_row(self, cells):
-        _get_style = self._get_style
+    _width_ratio = 1
+
+    def _write_cells(self, cells):
         _set_col_width = self._set_col_width
         get_metrics = self.get_metrics
-        tz = self.tz
-        has_tz_normalize = hasattr(tz, 'normalize')  # pytz
 
         row = self.sheet.row(self.row_idx)
         max_line = 1
         max_height = 0
         for idx, (value, style, width, line) in enumerate(cells):
-            if isinstance(value, datetime):
-                value = value.astimezone(tz)
-                if has_tz_normalize:
-                    value = tz.normalize(value)
-                value = datetime(*(value.timetuple()[0:6]))
-                if style == '[date]':
-                    width = len('YYYY-MM-DD')
-                elif style == '[time]':
-                    width = len('HH:MM:SS')
-                else:
-                    width = len('YYYY-MM-DD HH:MM:SS')
-                _set_col_width(idx, width)
-                row.set_cell_date(idx, value, _get_style(style))
-                continue
-            if isinstance(value, (int, long, float, Decimal)):
-                _set_col_width(idx, len('%g' % value))
-                row.set_cell_number(idx, value, _get_style(style))
-                continue
-            if value is True or value is False:
-                _set_col_width(idx, 1)
-                row.set_cell_number(idx, int(value), _get_style(style))
-                continue
-            if isinstance(value, basestring):
-                value = self._normalize_text(value)
             if width is None or line is None:
                 metrics = get_metrics(value)
                 if width is None:
@@ -568,30 +1197,566 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
             if max_line < line:
                 max_line = line
             _set_col_width(idx, width)
-            style = _get_style(style)
             if max_height < style.font.height:
                 max_height = style.font.height
             row.write(idx, value, style)
-            self._cells_count += 1
+        self._cells_count += len(cells)
         row.height = min(max_line, 10) * max(max_height * 255 / 180, 255)
         row.height_mismatch = True
         self.move_row()
 
+    def _convert_bool(self, value):
+        return int(value), 1, 1
+
     def _flush_row(self):
         if self.row_idx % 512 == 0 or self._cells_count >= 4096:
             self.sheet.flush_row_data()
             self._cells_count = 0
 
-    def _get_style(self, style):
-        if isinstance(style, basestring):
-            if style not in self.styles:
-                if style.endswith(':change'):
-                    style = '*:change'
-                else:
-                    style = '*'
-            style = self.styles[style]
-        return style
+    def _resolve_style(self, style):
+        style = AbstractWorksheetWriter._resolve_style(self, style)
+        return self.styles[style]
 
     def set_col_widths(self):
         for idx, width in self._col_widths.iteritems():
-            self.sheet.col(idx).width = (1 + min(width, 50)) * 256
+            self.sheet.col(idx).width = int((1 + min(width, 50)) * 256)
+
+
+_XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_XLSX_RELS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_XLSX_DOC_RELS = \
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_XLSX_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_XLSX_FONTS = (
+    '<font><sz val="9"/><name val="Arial"/></font>',
+    '<font><sz val="20"/><name val="Arial"/></font>',
+    '<font><sz val="16"/><name val="Arial"/></font>',
+    '<font><b/><sz val="9"/><color rgb="00FFFFFF"/><name val="Arial"/></font>',
+)
+_XLSX_FILLS = (
+    '<fill><patternFill patternType="none"/></fill>',
+    '<fill><patternFill patternType="gray125"/></fill>',
+    '<fill><patternFill patternType="solid"><fgColor rgb="00FF9900"/>'
+    '</patternFill></fill>',
+    '<fill><patternFill patternType="solid"><fgColor rgb="00000000"/>'
+    '</patternFill></fill>',
+)
+_XLSX_BORDERS = (
+    '<border><left/><right/><top/><bottom/><diagonal/></border>',
+    '<border><left style="thin"/><right style="thin"/><top style="thin"/>'
+    '<bottom style="thin"/><diagonal/></border>',
+    '<border><left style="thin"><color rgb="00FFFFFF"/></left>'
+    '<right style="thin"><color rgb="00FFFFFF"/></right>'
+    '<top style="thin"><color rgb="00FFFFFF"/></top>'
+    '<bottom style="thin"><color rgb="00FFFFFF"/></bottom>'
+    '<diagonal/></border>',
+)
+_XLSX_NUM_FMTS = ((164, '"#"0'), (165, 'HH:MM:SS'), (166, 'YYYY-MM-DD'),
+                  (167, 'YYYY-MM-DD HH:MM:SS'))
+_XLSX_ALIGN_BASE = '<alignment vertical="top" wrapText="1"/>'
+_XLSX_ALIGN_ID = '<alignment vertical="top" horizontal="right"/>'
+
+# name, (numFmtId, fontId, fillId, borderId, alignment)
+_XLSX_STYLES = (
+    ('header', (0, 1, 0, 0, None)),
+    ('header2', (0, 2, 0, 0, None)),
+    ('thead', (0, 3, 3, 2, None)),
+    ('id', (164, 0, 0, 1, _XLSX_ALIGN_ID)),
+    ('milestone', (49, 0, 0, 1, _XLSX_ALIGN_BASE)),
+    ('[time]', (165, 0, 0, 1, _XLSX_ALIGN_BASE)),
+    ('[date]', (166, 0, 0, 1, _XLSX_ALIGN_BASE)),
+    ('[datetime]', (167, 0, 0, 1, _XLSX_ALIGN_BASE)),
+    ('*', (49, 0, 0, 1, _XLSX_ALIGN_BASE)),
+)
+
+
+class _XlsxStyles(dict):
+    """The xf ids of the named styles, with the content of
+    `xl/styles.xml` in `xml`."""
+
+    def __init__(self, xf_ids, xml):
+        dict.__init__(self, xf_ids)
+        self.xml = xml
+
+
+def _make_xlsx_styles():
+    """Return the xf ids of the named styles with the content of
+    `xl/styles.xml`."""
+    xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+    xf_ids = {}
+    for base, (num_fmt, font, fill, border, alignment) in _XLSX_STYLES:
+        for name, fill in ((base, fill), ('%s:change' % base, 2)):
+            xf = '<xf numFmtId="%d" fontId="%d" fillId="%d" borderId="%d" ' \
+                 'xfId="0" applyNumberFormat="1" applyFont="1" ' \
+                 'applyFill="1" applyBorder="1"' % \
+                 (num_fmt, font, fill, border)
+            if alignment:
+                xf += ' applyAlignment="1">%s</xf>' % alignment
+            else:
+                xf += '/>'
+            xf_ids[name] = len(xfs)
+            xfs.append(xf)
+
+    def element(tag, items):
+        return '<%s count="%d">%s</%s>' % (tag, len(items), ''.join(items),
+                                           tag)
+
+    content = ''.join((
+        _XLSX_XML_DECL,
+        '<styleSheet xmlns="%s">' % _XLSX_NS,
+        element('numFmts', ['<numFmt numFmtId="%d" formatCode="%s"/>' %
+                            (id, _xml_escape(code, True))
+                            for id, code in _XLSX_NUM_FMTS]),
+        element('fonts', _XLSX_FONTS),
+        element('fills', _XLSX_FILLS),
+        element('borders', _XLSX_BORDERS),
+        element('cellStyleXfs', ['<xf numFmtId="0" fontId="0" fillId="0" '
+                                 'borderId="0"/>']),
+        element('cellXfs', xfs),
+        element('cellStyles', ['<cellStyle name="Normal" xfId="0" '
+                               'builtinId="0"/>']),
+        '</styleSheet>'))
+    return _XlsxStyles(xf_ids, content)
+
+
+def _xml_escape(value, quote=False):
+    value = value.replace('&', '&amp;').replace('<', '&lt;') \
+                 .replace('>', '&gt;')
+    if quote:
+        value = value.replace('"', '&quot;')
+    return value
+
+
+def _xlsx_rows_xml(rows):
+    """Serialize the rows to `<row>` elements of a worksheet.
+
+    `rows` is a sequence of `(row_idx, cells)` and each cell is a tuple
+    of xf id and value.
+    """
+    buf = []
+    append = buf.append
+    for row_idx, cells in rows:
+        append(u'<row r="%d">' % (row_idx + 1))
+        for xf, value in cells:
+            if value is None:
+                append(u'<c s="%d"/>' % xf)
+            elif value is True or value is False:
+                append(u'<c s="%d" t="b"><v>%d</v></c>' % (xf, value))
+            elif isinstance(value, unicode):
+                append(u'<c s="%d" t="inlineStr"><is>'
+                       u'<t xml:space="preserve">%s</t></is></c>' %
+                       (xf, _xml_escape(value)))
+            elif isinstance(value, float):
+                append(u'<c s="%d"><v>%r</v></c>' % (xf, value))
+            else:
+                append(u'<c s="%d"><v>%s</v></c>' % (xf, value))
+        append(u'</row>')
+    return u''.join(buf).encode('utf-8')
+
+
+def _compress_rows(rows, level):
+    """Serialize and compress the rows in a process of the pool. Return
+    the compressed data which can be concatenated to the other data
+    compressed with a full flush, with the crc and the size of the
+    uncompressed data. The data is not compressed if `level` is `None`."""
+    data = _xlsx_rows_xml(rows)
+    if level is None:
+        return data, zlib.crc32(data), len(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + \
+                 compressor.flush(zlib.Z_FULL_FLUSH)
+    return compressed, zlib.crc32(data), len(data)
+
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def _get_process_pool(env, size):
+    """Return a pool of `size` processes shared in the process, or `None`
+    if the pool is disabled or cannot be created. The pools are never
+    closed until the process exits, because the writers of the other
+    threads may use them."""
+    if size <= 0:
+        return None
+    with _process_pools_lock:
+        pool = _process_pools.get(size)
+        if pool is None:
+            try:
+                import multiprocessing
+                pool = multiprocessing.Pool(size)
+            except (ImportError, OSError), e:
+                env.log.warning('Unable to create processes to compress '
+                                'Excel files: %s', to_unicode(e))
+                return None
+            atexit.register(_stop_process_pool, pool)
+            _process_pools[size] = pool
+        return pool
+
+
+def _stop_process_pool(pool):
+    pool.close()
+    pool.join()
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    idx = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[idx]
+        vec >>= 1
+        idx += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in xrange(32)]
+
+
+def _crc32_zeros_operators():
+    # operator for one zero bit, then squared for 2**n zero bytes
+    op = [0xedb88320] + [1 << n for n in xrange(31)]
+    for n in xrange(3):
+        op = _gf2_matrix_square(op)
+    ops = []
+    for n in xrange(64):
+        ops.append(op)
+        op = _gf2_matrix_square(op)
+    return ops
+
+_crc32_zeros_ops = _crc32_zeros_operators()
+
+
+def _crc32_combine(crc1, crc2, len2):
+    """Return the crc of the concatenated data from the crc of each data,
+    like `crc32_combine()` of zlib."""
+    crc1 &= 0xffffffff
+    for op in _crc32_zeros_ops:
+        if not len2:
+            break
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(op, crc1)
+        len2 >>= 1
+    return crc1 ^ (crc2 & 0xffffffff)
+
+
+class _ZipfileArchive(ZipFile):
+    """`ZipFile` which writes to non-seekable stream and accepts members
+    compressed in advance. The members are compressed with `level` of
+    deflate, or stored if `None`."""
+
+    def __init__(self, out, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._out = _PositionStream(out)
+        self.level = level
+        ZipFile.__init__(self, self._out, 'w',
+                         ZIP_STORED if level is None else ZIP_DEFLATED,
+                         allowZip64=True)
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None):
+        if isinstance(zinfo_or_arcname, ZipInfo):
+            arcname = zinfo_or_arcname.filename
+        else:
+            arcname = zinfo_or_arcname
+        crc = zlib.crc32(data)
+        if self.level is None:
+            compressed = data
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        self.write_compressed(arcname, StringIO(compressed), crc, len(data),
+                              len(compressed), self.compression)
+
+    def write_compressed(self, arcname, fileobj, crc, file_size,
+                         compress_size, compress_type=ZIP_DEFLATED):
+        zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0600 << 16
+        zinfo.compress_type = compress_type
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        zip64 = file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
+        self.fp.write(zinfo.FileHeader(zip64))
+        fileobj.seek(0)
+        while True:
+            data = fileobj.read(65536)
+            if not data:
+                break
+            self.fp.write(data)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+class _PositionStream(object):
+
+    def __init__(self, out):
+        self.out = out
+        self._pos = 0
+
+    def write(self, data):
+        self.out.write(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+
+class _CompressedPart(object):
+    """Temporary file which receives a member of zip archive and stores
+    it compressed."""
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.file = TemporaryFile()
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.level = level
+        if level is None:
+            self.compress_type = ZIP_STORED
+            self._compressor = None
+        else:
+            self.compress_type = ZIP_DEFLATED
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self._compressor:
+            data = self._compressor.compress(data)
+        if data:
+            self._write_raw(data)
+
+    def set_level(self, level):
+        """Compress the following data with `level`. The level of a part
+        stored without compression cannot be changed."""
+        if self._compressor and level is not None and level != self.level:
+            self._write_raw(self._compressor.flush(zlib.Z_FULL_FLUSH))
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self.level = level
+
+    def write_compressed(self, data, crc, size):
+        """Append the data compressed with a full flush in advance."""
+        # end the pending data and reset the history of the compressor,
+        # in order to not refer to the data compressed in advance
+        if self._compressor:
+            self._write_raw(self._compressor.flush(zlib.Z_FULL_FLUSH))
+        self._write_raw(data)
+        self.crc = _crc32_combine(self.crc, crc, size)
+        self.file_size += size
+
+    def _write_raw(self, data):
+        self.file.write(data)
+        self.compress_size += len(data)
+
+    def close(self):
+        if self._compressor:
+            data = self._compressor.flush()
+            self._compressor = None
+            self.file.write(data)
+            self.compress_size += len(data)
+
+
+class ZipfileWorkbookWriter(AbstractWorkbookWriter):
+
+    ext = 'xlsx'
+    mimetype = 'application/' \
+               'vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def __init__(self, env, req):
+        AbstractWorkbookWriter.__init__(self, env, req, None)
+        processes = ExcelDownloadConfig(env).compress_processes
+        self.pool = _get_process_pool(env, processes)
+        self.max_pending = processes * 2
+
+    def create_sheet(self, title):
+        return ZipfileWorksheetWriter(title, self)
+
+    def dump(self, out):
+        if not self.sheets:
+            self.create_sheet('Sheet')
+        sheets = self.sheets
+        for sheet in sheets:
+            sheet.close()
+
+        archive = _ZipfileArchive(out, self.get_compress_level())
+        archive.writestr('[Content_Types].xml', ''.join((
+            _XLSX_XML_DECL,
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types">'
+            '<Default Extension="rels" ContentType="application/'
+            'vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"'
+            '/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>',
+            ''.join('<Override PartName="/xl/worksheets/sheet%d.xml" '
+                    'ContentType="application/vnd.openxmlformats-'
+                    'officedocument.spreadsheetml.worksheet+xml"/>' % idx
+                    for idx in xrange(1, len(sheets) + 1)),
+            '</Types>')))
+        archive.writestr('_rels/.rels', ''.join((
+            _XLSX_XML_DECL,
+            '<Relationships xmlns="%s">' % _XLSX_RELS_NS,
+            '<Relationship Id="rId1" Type="%s/officeDocument" '
+            'Target="xl/workbook.xml"/>' % _XLSX_DOC_RELS,
+            '</Relationships>')))
+        archive.writestr('xl/workbook.xml', ''.join((
+            _XLSX_XML_DECL,
+            '<workbook xmlns="%s" xmlns:r="%s"><sheets>' %
+            (_XLSX_NS, _XLSX_DOC_RELS),
+            ''.join('<sheet name="%s" sheetId="%d" r:id="rId%d"/>' %
+                    (_xml_escape(sheet.title, True).encode('utf-8'), idx, idx)
+                    for idx, sheet in enumerate(sheets, 1)),
+            '</sheets></workbook>')))
+        archive.writestr('xl/_rels/workbook.xml.rels', ''.join((
+            _XLSX_XML_DECL,
+            '<Relationships xmlns="%s">' % _XLSX_RELS_NS,
+            ''.join('<Relationship Id="rId%d" Type="%s/worksheet" '
+                    'Target="worksheets/sheet%d.xml"/>' %
+                    (idx, _XLSX_DOC_RELS, idx)
+                    for idx in xrange(1, len(sheets) + 1)),
+            '<Relationship Id="rId%d" Type="%s/styles" Target="styles.xml"/>'
+            % (len(sheets) + 1, _XLSX_DOC_RELS),
+            '</Relationships>')))
+        archive.writestr('xl/styles.xml', self.styles.xml)
+        for idx, sheet in enumerate(sheets, 1):
+            part = sheet.part
+            archive.write_compressed('xl/worksheets/sheet%d.xml' % idx,
+                                     part.file, part.crc, part.file_size,
+                                     part.compress_size, part.compress_type)
+            part.file.close()
+        archive.close()
+
+    def _create_excel_styles(self):
+        return _make_xlsx_styles()
+
+
+class ZipfileWorksheetWriter(AbstractWorksheetWriter):
+
+    MAX_ROWS = 1048576
+    MAX_COLS = 16384
+    MAX_CHARS = 32767
+
+    _chunk_rows = 256
+    _process_chunk_rows = 4096
+
+    def __init__(self, title, writer):
+        title = re.sub(r'[\[\]:*?/\\]', '_', to_unicode(title))[:31]
+        AbstractWorksheetWriter.__init__(self, title, writer)
+        self.title = title
+        self.part = _CompressedPart(writer.get_compress_level())
+        self._pool = writer.pool
+        if self._pool:
+            self._chunk_rows = self._process_chunk_rows
+            # the chunks compressed in the processes, in order of the rows
+            self._pending = []
+            self._max_pending = writer.max_pending
+        self._rows = []
+        self._sample_rows = max(writer.width_sample_rows, 0)
+        self._streaming = False
+        self._closed = False
+
+    def _write_cells(self, cells):
+        if self._streaming:
+            self._rows.append((self.row_idx,
+                               [(xf, value)
+                                for value, xf, width, line in cells]))
+            if len(self._rows) >= self._chunk_rows:
+                self._flush_rows()
+        else:
+            get_metrics = self.get_metrics
+            values = []
+            for idx, (value, xf, width, line) in enumerate(cells):
+                if width is None or line is None:
+                    metrics = get_metrics(value)
+                    if width is None:
+                        width = metrics[0]
+                    if line is None:
+                        line = metrics[1]
+                values.append((xf, value))
+                self._set_col_width(idx, width)
+            self._rows.append((self.row_idx, values))
+            if self._sample_rows and len(self._rows) >= self._sample_rows:
+                self._start_streaming()
+        self.row_idx += 1
+
+    def _convert_datetime(self, value):
+        return self._tz_converter.to_serial(value)
+
+    def _normalize_text(self, value):
+        value = AbstractWorksheetWriter._normalize_text(self, value)
+        if value == u'':
+            value = None
+        return value
+
+    def _resolve_style(self, style):
+        style = AbstractWorksheetWriter._resolve_style(self, style)
+        return self.styles[style]
+
+    def set_col_widths(self):
+        if not self._streaming:
+            self._start_streaming()
+
+    def close(self):
+        if self._closed:
+            return
+        self.set_col_widths()
+        self._flush_rows()
+        if self._pool:
+            self._write_pending(0)
+        self.part.write('</sheetData></worksheet>')
+        self.part.close()
+        self._closed = True
+
+    def _start_streaming(self):
+        cols = ''.join('<col min="%(idx)d" max="%(idx)d" width="%(width)g" '
+                       'customWidth="1"/>' %
+                       {'idx': idx + 1, 'width': 1 + min(width, 50)}
+                       for idx, width in sorted(self._col_widths.iteritems()))
+        if cols:
+            cols = '<cols>%s</cols>' % cols
+        self.part.write('%s<worksheet xmlns="%s">%s<sheetData>' %
+                        (_XLSX_XML_DECL, _XLSX_NS, cols))
+        self._streaming = True
+        self._flush_rows()
+
+    def _flush_rows(self):
+        if not self._rows:
+            return
+        # the level is changed when the workbook becomes large
+        self.part.set_level(self.writer.get_compress_level())
+        if self._pool:
+            try:
+                result = self._pool.apply_async(
+                    _compress_rows, (self._rows, self.part.level))
+            except (AssertionError, ValueError), e:
+                # the pool is no longer running, compress the following
+                # rows in the thread
+                self.writer.log.warning('Unable to compress rows of Excel '
+                                        'file in processes: %s',
+                                        exception_to_unicode(e))
+                self._write_pending(0)
+                self._pool = None
+            else:
+                self._pending.append(result)
+                # the list is pickled later by the pool
+                self._rows = []
+                self._write_pending(self._max_pending)
+                return
+        self.part.write(_xlsx_rows_xml(self._rows))
+        self._rows[:] = ()
+
+    def _write_pending(self, limit):
+        pending = self._pending
+        while len(pending) > limit:
+            data, crc, size = pending.pop(0).get()
+            self.part.write_compressed(data, crc, size)
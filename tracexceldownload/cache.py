@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+from hashlib import sha1
+from tempfile import NamedTemporaryFile
+
+from trac.core import Component
+from trac.perm import PermissionSystem
+from trac.util.text import to_utf8
+
+from tracexceldownload.api import (get_excel_format,
+                                   has_fine_grained_permissions)
+from tracexceldownload.translation import IntOption, N_, PathOption
+
+
+__all__ = ('ExcelDownloadCache',)
+
+
+class ExcelDownloadCache(Component):
+
+    cache_dir = PathOption('exceldownload', 'cache_dir', '',
+        doc=N_("Directory to store the cached Excel files. Relative paths "
+               "are resolved relative to the `conf` directory of the "
+               "environment. If empty, `files/exceldownload/cache` in the "
+               "environment is used."))
+
+    cache_size = IntOption('exceldownload', 'cache_size', 0,
+        doc=N_("Maximum total size in megabytes of the cached Excel files "
+               "of query and report downloads. The least recently used "
+               "files are removed when exceeding the size. If `0`, the "
+               "cache is disabled. Queries with relative dates, e.g. "
+               "`changetime=-1w..`, reports using the current time, e.g. "
+               "`NOW()`, and reports reading other tables than the "
+               "tickets, `ticket_change`, `enum`, `component`, "
+               "`milestone`, `version` and `wiki` are not cached."))
+
+    @property
+    def enabled(self):
+        return self.cache_size > 0
+
+    @property
+    def directory(self):
+        return self.cache_dir or \
+               os.path.join(self.env.path, 'files', 'exceldownload', 'cache')
+
+    def get_key(self, req, *args):
+        """Return the cache key of the download from `args` which identify
+        the content, and from the format, the locale, the timezone and the
+        permissions of the user."""
+        tz = getattr(req.tz, 'zone', None) or str(req.tz)
+        locale = getattr(req, 'locale', None)
+        values = [get_excel_format(self.env), str(locale), tz]
+        values.extend(self._get_permission_scope(req))
+        values.extend(args)
+        return sha1('\0'.join(to_utf8(unicode(value))
+                              for value in values)).hexdigest()
+
+    def get(self, key, ext):
+        """Return the path of the cached file or `None`. The file is
+        marked as recently used."""
+        path = self._get_path(key, ext)
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def store(self, key, book):
+        """Write the workbook to the cache and return the path of the
+        file."""
+        directory = self.directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = self._get_path(key, book.ext)
+        f = NamedTemporaryFile(dir=directory, prefix='.tmp-', delete=False)
+        try:
+            try:
+                book.dump(f)
+            finally:
+                f.close()
+            os.rename(f.name, path)
+        except:
+            os.unlink(f.name)
+            raise
+        self._evict()
+        return path
+
+    def _get_path(self, key, ext):
+        return os.path.join(self.directory, '%s.%s' % (key, ext))
+
+    def _get_permission_scope(self, req):
+        if has_fine_grained_permissions(self.env):
+            return [req.authname]
+        # the permissions are decided by only the actions which the user
+        # has, without the tickets
+        perms = PermissionSystem(self.env).get_user_permissions(req.authname)
+        return sorted(action for action, granted in perms.iteritems()
+                             if granted)
+
+    def _evict(self):
+        directory = self.directory
+        entries = []
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        limit = self.cache_size * 1024 * 1024
+        for mtime, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
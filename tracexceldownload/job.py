@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import errno
+import json
+import os
+import re
+import socket
+import threading
+import time
+from Queue import Full, Queue
+from uuid import uuid4
+
+from pkg_resources import resource_filename
+
+from trac.core import Component, TracError, implements
+from trac.perm import PermissionError
+from trac.util.text import exception_to_unicode
+from trac.web.api import HTTPNotFound, IRequestHandler
+from trac.web.chrome import ITemplateProvider
+
+from tracexceldownload.api import (get_excel_format, get_excel_mimetype,
+                                   get_workbook_writer, send_workbook_file)
+from tracexceldownload.translation import _, IntOption, N_, PathOption
+
+
+__all__ = ('ExcelDownloadJobModule',)
+
+
+_JOB_LIFETIME = 24 * 60 * 60
+
+
+class _DetachedRequest(object):
+    """Copy of the attributes of a request used to generate an Excel file
+    in a worker thread after the request is finished."""
+
+    def __init__(self, req):
+        self.authname = req.authname
+        self.perm = req.perm
+        self.tz = req.tz
+        self.locale = getattr(req, 'locale', None)
+        self.lc_time = getattr(req, 'lc_time', None)
+        self.href = req.href
+        self.abs_href = req.abs_href
+        self.args = copy.copy(req.args)
+        self.environ = {}
+
+
+class ExportJob(object):
+    """An Excel download generated in a worker thread. `req` is a detached
+    request."""
+
+    def __init__(self, env, req, filename, total, build, compression=None):
+        self.env = env
+        self.req = req
+        self.id = uuid4().hex
+        self.authname = req.authname
+        self.filename = filename
+        self.total = total
+        self.build = build
+        self.compression = compression
+        self.status = 'queued'
+        self.error = None
+        self.book = None
+
+    @property
+    def rows(self):
+        book = self.book
+        return book.rows_written if book else None
+
+    def run(self, directory):
+        self.status = 'running'
+        try:
+            book = get_workbook_writer(self.env, self.req)
+            self.book = book
+            if self.compression:
+                book.set_compression(self.compression)
+            self.build(self.req, book)
+            path = os.path.join(directory, '%s.%s' % (self.id, book.ext))
+            f = open(path + '.tmp', 'wb')
+            try:
+                book.dump(f)
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+            self.status = 'done'
+        except Exception, e:
+            self.env.log.error('Excel download job %s failed: %s', self.id,
+                               exception_to_unicode(e, traceback=True))
+            self.error = exception_to_unicode(e)
+            self.status = 'failed'
+            _write_json(os.path.join(directory, '%s.error' % self.id),
+                        {'error': self.error})
+        finally:
+            self.book = None
+            self.build = None
+            self.req = None
+
+
+class _WorkerPool(object):
+
+    def __init__(self, env, size):
+        self.env = env
+        self._queue = Queue(size * 8)
+        for idx in xrange(size):
+            thread = threading.Thread(target=self._run,
+                                      name='exceldownload-worker-%d' % idx)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, fn):
+        try:
+            self._queue.put_nowait(fn)
+        except Full:
+            raise TracError(_("Too many Excel downloads are in progress. "
+                              "Please try again later."))
+
+    def _run(self):
+        tid = threading.current_thread().ident
+        while True:
+            fn = self._queue.get()
+            try:
+                fn()
+            finally:
+                self.env.shutdown(tid)
+
+
+def _write_json(path, data):
+    f = open(path, 'w')
+    try:
+        json.dump(data, f)
+    finally:
+        f.close()
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _read_json(path):
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+class ExcelDownloadJobModule(Component):
+
+    implements(IRequestHandler, ITemplateProvider)
+
+    async_threshold = IntOption('exceldownload', 'async_threshold', 0,
+        doc=N_("Number of rows above which an Excel download is generated "
+               "in a background worker thread. The user is redirected to "
+               "a page showing the progress and the download link. If `0`, "
+               "Excel files are always generated in the request."))
+
+    jobs_dir = PathOption('exceldownload', 'jobs_dir', '',
+        doc=N_("Directory to store the Excel files generated in background. "
+               "Relative paths are resolved relative to the `conf` "
+               "directory of the environment. If empty, "
+               "`files/exceldownload/jobs` in the environment is used."))
+
+    async_workers = IntOption('exceldownload', 'async_workers', 2,
+        doc=N_("Number of worker threads per process generating Excel "
+               "files in background."))
+
+    job_timeout = IntOption('exceldownload', 'job_timeout', 3600,
+        doc=N_("Number of seconds after which an Excel download generated "
+               "in background which has not finished is shown as failed. "
+               "The download is shown as failed before the timeout if the "
+               "process generating it has died."))
+
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self._pool = None
+        self._jobs = {}
+
+    @property
+    def directory(self):
+        return self.jobs_dir or \
+               os.path.join(self.env.path, 'files', 'exceldownload', 'jobs')
+
+    @property
+    def enabled(self):
+        return self.async_threshold > 0
+
+    def is_async(self, rows):
+        """Return `True` if the download of `rows` rows should be
+        generated in background."""
+        return 0 < self.async_threshold < rows
+
+    def submit(self, req, filename, total, build):
+        """Generate the Excel file in background and redirect to the
+        progress page. `build` is called with a detached copy of the
+        request and a workbook writer to write sheets. The `compression`
+        argument of the request overrides the compression of the file."""
+        directory = self.directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._cleanup(directory)
+
+        job = ExportJob(self.env, _DetachedRequest(req), filename, total,
+                        build, req.args.get('compression'))
+        meta_path = os.path.join(directory, '%s.json' % job.id)
+        _write_json(meta_path,
+                    {'authname': job.authname, 'sid': self._get_sid(req),
+                     'filename': filename, 'ext': get_excel_format(self.env),
+                     'time': time.time(), 'host': socket.gethostname(),
+                     'pid': os.getpid()})
+        with self._lock:
+            if self._pool is None:
+                self._pool = _WorkerPool(self.env,
+                                         max(self.async_workers, 1))
+            self._jobs[job.id] = job
+        try:
+            self._pool.submit(lambda: job.run(directory))
+        except TracError:
+            # the queue is full, the job would stay queued
+            with self._lock:
+                del self._jobs[job.id]
+            os.unlink(meta_path)
+            raise
+        req.redirect(req.href('exceldownload', 'job', job.id))
+
+    # IRequestHandler methods
+
+    _PATH_INFO_MATCH = re.compile(
+        r'/exceldownload/job/([0-9a-f]{32})(/download)?$').match
+
+    def match_request(self, req):
+        match = self._PATH_INFO_MATCH(req.path_info)
+        if match:
+            req.args['id'] = match.group(1)
+            req.args['download'] = bool(match.group(2))
+            return True
+
+    def process_request(self, req):
+        id = req.args['id']
+        job = self._get_job(id)
+        if not job:
+            raise HTTPNotFound(_("Excel download %(id)s not found", id=id))
+        if job['authname'] != req.authname or \
+                job['sid'] != self._get_sid(req):
+            raise PermissionError(msg=_("Excel download %(id)s is not "
+                                        "yours.", id=id))
+        if req.args['download']:
+            if job['status'] != 'done':
+                raise HTTPNotFound(_("Excel download %(id)s is not ready",
+                                     id=id))
+            send_workbook_file(self.env, req, job['path'], job['mimetype'],
+                               job['filename'])
+        data = {'job': job,
+                'download_href': req.href('exceldownload', 'job', id,
+                                          'download')}
+        return 'exceldownload_job.html', data, None
+
+    # ITemplateProvider methods
+
+    def get_htdocs_dirs(self):
+        return []
+
+    def get_templates_dirs(self):
+        return [resource_filename(__name__, 'templates')]
+
+    # Internal methods
+
+    def _get_sid(self, req):
+        # anonymous users are distinguished by the session
+        if req.authname == 'anonymous':
+            return req.session.sid
+
+    def _get_job(self, id):
+        directory = self.directory
+        meta = _read_json(os.path.join(directory, '%s.json' % id))
+        if meta is None:
+            return None
+        values = {'id': id, 'authname': meta['authname'],
+                  'sid': meta.get('sid'),
+                  'filename': meta['filename'], 'status': 'running',
+                  'rows': None, 'total': None, 'error': None,
+                  'mimetype': get_excel_mimetype(meta['ext']),
+                  'path': os.path.join(directory,
+                                       '%s.%s' % (id, meta['ext']))}
+        job = self._jobs.get(id)
+        if job:
+            values.update(status=job.status, rows=job.rows, total=job.total,
+                          error=job.error)
+        # the job may be run by another process
+        if os.path.exists(values['path']):
+            values['status'] = 'done'
+        else:
+            error = _read_json(os.path.join(directory, '%s.error' % id))
+            if error:
+                values.update(status='failed', error=error['error'])
+            elif not job and self._is_stale(meta):
+                values.update(status='failed',
+                              error=_("The generation was interrupted."))
+        return values
+
+    def _is_stale(self, meta):
+        if time.time() - meta.get('time', 0) > self.job_timeout:
+            return True
+        # the process is checked only on the same host
+        pid = meta.get('pid')
+        return pid and meta.get('host') == socket.gethostname() and \
+               pid != os.getpid() and not _is_process_alive(pid)
+
+    def _cleanup(self, directory):
+        expires = time.time() - _JOB_LIFETIME
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < expires:
+                    os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            for id in [id for id, job in self._jobs.iteritems()
+                          if job.status in ('done', 'failed')]:
+                if not os.path.exists(os.path.join(directory,
+                                                   '%s.json' % id)):
+                    del self._jobs[id]
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the query, history and report exports with synthetic
+tickets.
+
+Usage::
+
+    python -m tracexceldownload.tests.benchmark [--tickets 1000,10000]
+        [--formats xls,xlsx,xlsx-builtin] [--save-baseline FILE]
+        [--baseline FILE]
+
+    python -m tracexceldownload.tests.benchmark --tickets 100000 \
+        --formats xlsx-builtin --exports query,report-direct
+
+The tickets are generated in the database of `TRAC_TEST_DB_URI`, or in a
+temporary SQLite database if not set. The tables of the database are
+reset. Each export is run in a child process in order to measure the
+peak of the resident memory.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.api import TicketSystem
+from trac.ticket.query import Query
+from trac.ticket.report import ReportModule
+from trac.util.datefmt import to_utimestamp, utc
+
+from tracexceldownload.api import get_workbook_writer
+from tracexceldownload.ticket import ExcelTicketModule, ExcelReportModule
+
+
+_exports = ('query', 'history', 'report', 'report-direct')
+_field_types = ('text', 'select', 'checkbox', 'time', 'textarea')
+_options = ('', 'foo', 'bar', 'baz', 'qux')
+_cjk_chars = map(unichr, range(0x3041, 0x3097) + range(0x4e00, 0x4f00))
+_latin_chars = map(unichr, range(0x61, 0x7b)) + [u' '] * 5
+
+
+def _create_env(options, destroying=False):
+    env = EnvironmentStub(default_data=not destroying, destroying=destroying)
+    for idx in xrange(options.custom_fields):
+        name = 'col_%d' % idx
+        type = _field_types[idx % len(_field_types)]
+        env.config.set('ticket-custom', name, type)
+        if type == 'select':
+            env.config.set('ticket-custom', name + '.options',
+                           '|'.join(_options))
+        elif type == 'time':
+            env.config.set('ticket-custom', name + '.format', 'datetime')
+    return env
+
+
+def _text(rnd, size, cjk):
+    chars = _cjk_chars if cjk else _latin_chars
+    return u''.join(rnd.choice(chars) for idx in xrange(size))
+
+
+def _populate(env, options, count):
+    """Insert `count` tickets with the custom fields and the changes."""
+    rnd = random.Random(count)
+    start = to_utimestamp(datetime(2016, 1, 1, tzinfo=utc))
+    hour = 3600 * 1000000
+    fields = [('col_%d' % idx, _field_types[idx % len(_field_types)])
+              for idx in xrange(options.custom_fields)]
+    batch = 1000
+
+    def custom_value(type, id):
+        if type == 'select':
+            return _options[id % len(_options)]
+        if type == 'checkbox':
+            return str(id % 2)
+        if type == 'time':
+            return str(start + id * hour)
+        return _text(rnd, 20 if type == 'text' else 200, options.cjk)
+
+    with env.db_transaction as db:
+        cursor = db.cursor()
+        for offset in xrange(0, count, batch):
+            tickets = []
+            customs = []
+            changes = []
+            for id in xrange(offset + 1, min(offset + batch, count) + 1):
+                time = start + id * hour
+                changetime = time + options.changes * hour
+                tickets.append((
+                    id, 'defect', time, changetime,
+                    'component%d' % (id % 2 + 1), 'major', 'minor',
+                    'owner%d' % (id % 50), 'reporter%d' % (id % 100),
+                    'cc%d@example.org' % (id % 10), '',
+                    'milestone%d' % (id % 4 + 1), 'new', '',
+                    _text(rnd, 40, options.cjk),
+                    _text(rnd, 400, options.cjk), 'keyword'))
+                customs.extend((id, name, custom_value(type, id))
+                               for name, type in fields)
+                for cnum in xrange(1, options.changes + 1):
+                    t = time + cnum * hour
+                    author = 'user%d' % (cnum % 20)
+                    changes.append((id, t, author, 'comment', str(cnum),
+                                    _text(rnd, 100, options.cjk)))
+                    changes.append((id, t, author, 'owner',
+                                    'owner%d' % (cnum - 1),
+                                    'owner%d' % cnum))
+                    if fields:
+                        name, type = fields[cnum % len(fields)]
+                        changes.append((id, t, author, name, '',
+                                        custom_value(type, id + cnum)))
+            cursor.executemany("""
+                INSERT INTO ticket (id,type,time,changetime,component,
+                                    severity,priority,owner,reporter,cc,
+                                    version,milestone,status,resolution,
+                                    summary,description,keywords)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                """, tickets)
+            cursor.executemany("""
+                INSERT INTO ticket_custom (ticket,name,value)
+                VALUES (%s,%s,%s)""", customs)
+            cursor.executemany("""
+                INSERT INTO ticket_change (ticket,time,author,field,
+                                           oldvalue,newvalue)
+                VALUES (%s,%s,%s,%s,%s,%s)""", changes)
+        cursor.execute("""
+            INSERT INTO report (title,query,description)
+            VALUES (%s,%s,%s)""",
+            ('Benchmark',
+             'SELECT milestone AS __group__, id AS ticket, summary, '
+             'component, owner, reporter, time AS created, '
+             'changetime AS modified, description AS _description_ '
+             'FROM ticket ORDER BY milestone, id', ''))
+        return db.get_last_id(cursor, 'report')
+
+
+def _current_rss():
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * resource.getpagesize()
+    finally:
+        f.close()
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _export_query(env, req, query_string, sheet_history):
+    query = Query.from_string(env, query_string)
+    mod = ExcelTicketModule(env)
+    return mod._convert_query(req, query, sheet_history=sheet_history)
+
+
+def _export_report(env, req, report_id, format, mode):
+    env.config.set('exceldownload', 'report_mode', mode)
+    mod = ExcelReportModule(env)
+    report_mod = ReportModule(env)
+    books = []
+
+    def send_report(req, filename, numrows, build):
+        book = get_workbook_writer(env, req)
+        build(req, book)
+        books.append(book)
+
+    mod._send_report = send_report
+    req.args.update({'id': str(report_id), 'format': format})
+    mod.pre_process_request(req, report_mod)
+    if not books:
+        template, data, content_type = report_mod.process_request(req)
+        mod.post_process_request(req, template, data, content_type)
+    return books[0]
+
+
+def _run_case(options, case, report_id, conn):
+    try:
+        env = _create_env(options, destroying=True)
+        env.config.set('exceldownload', 'format', case['format'])
+        format = 'xls' if case['format'] == 'xls' else 'xlsx'
+        fields = [f['name'] for f in TicketSystem(env).get_ticket_fields()
+                             if f['name'] not in ('description',)]
+        query_string = 'max=0&order=id&' + \
+                       '&'.join('col=%s' % name for name in fields)
+        req = MockRequest(env, path_info='/report/%d' % report_id)
+        rss = _current_rss()
+        start = time.time()
+        export = case['export']
+        if export in ('query', 'history'):
+            book = _export_query(env, req, query_string,
+                                 export == 'history')
+        else:
+            mode = 'direct' if export == 'report-direct' else 'rendered'
+            book = _export_report(env, req, report_id, format, mode)
+        rows = book.rows_written
+        out = tempfile.TemporaryFile()
+        try:
+            book.dump(out)
+            size = out.tell()
+        finally:
+            out.close()
+        seconds = time.time() - start
+        peak = _peak_rss()
+        env.shutdown()
+        result = dict(case, rows=rows, seconds=seconds,
+                      rows_per_sec=rows / seconds if seconds else None,
+                      size=size, peak_rss=peak,
+                      rss_delta=peak - rss if rss is not None else None)
+    except Exception, e:
+        result = dict(case, error='%s: %s' % (e.__class__.__name__, e))
+    conn.send(result)
+    conn.close()
+
+
+def _run(options, case, report_id):
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_case,
+                                      args=(options, case, report_id, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = dict(case, error='exit code %s' % process.exitcode)
+    process.join()
+    return result
+
+
+def _case_name(case):
+    return '%(export)s/%(format)s/%(tickets)d' % case
+
+
+def _format_bytes(value):
+    if value is None:
+        return '-'
+    return '%.1fM' % (value / 1048576.0)
+
+
+def _print_result(result, baseline):
+    name = _case_name(result)
+    if 'error' in result:
+        print '%-32s %s' % (name, result['error'])
+        return
+    line = '%-32s %8d rows %8.2fs %10.0f rows/s %9s peak %9s delta ' \
+           '%9s size' % (name, result['rows'], result['seconds'],
+                         result['rows_per_sec'] or 0,
+                         _format_bytes(result['peak_rss']),
+                         _format_bytes(result['rss_delta']),
+                         _format_bytes(result['size']))
+    base = baseline.get(name)
+    if base and 'error' not in base and base['rows_per_sec'] and \
+            result['rows_per_sec']:
+        line += ' %+6.1f%% rows/s %+6.1f%% peak' % (
+            (result['rows_per_sec'] / base['rows_per_sec'] - 1) * 100,
+            (float(result['peak_rss']) / base['peak_rss'] - 1) * 100)
+    print line
+
+
+def _is_regression(result, base, tolerance):
+    if 'error' in result or not base or 'error' in base:
+        return False
+    return result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance) \
+           or result['peak_rss'] > base['peak_rss'] * (1 + tolerance)
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the Excel downloads with synthetic "
+                    "tickets.")
+    parser.add_argument('--tickets', default='1000,10000',
+                        help="comma-separated numbers of tickets "
+                             "(default: %(default)s)")
+    parser.add_argument('--formats', default='xls,xlsx,xlsx-builtin',
+                        help="comma-separated formats "
+                             "(default: %(default)s)")
+    parser.add_argument('--exports', default=','.join(_exports),
+                        help="comma-separated exports "
+                             "(default: %(default)s)")
+    parser.add_argument('--custom-fields', type=int, default=20,
+                        help="number of custom fields "
+                             "(default: %(default)s)")
+    parser.add_argument('--changes', type=int, default=10,
+                        help="number of changes per ticket "
+                             "(default: %(default)s)")
+    parser.add_argument('--no-cjk', dest='cjk', action='store_false',
+                        help="generate ASCII texts instead of CJK texts")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare with the results saved in FILE")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="save the results to FILE")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="ratio of the slowdown or the memory growth "
+                             "reported as a regression "
+                             "(default: %(default)s)")
+    options = parser.parse_args(argv)
+    options.tickets = [int(value) for value in _split(options.tickets)]
+    options.formats = _split(options.formats)
+    options.exports = _split(options.exports)
+    for export in options.exports:
+        if export not in _exports:
+            parser.error('invalid export: %s' % export)
+    return options
+
+
+def main(argv=None):
+    options = _parse_args(argv)
+    baseline = {}
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)['results']
+        finally:
+            f.close()
+
+    tempdir = None
+    dburi = os.environ.get('TRAC_TEST_DB_URI')
+    if not dburi or dburi.endswith(':memory:'):
+        # the database is shared with the child processes
+        tempdir = tempfile.mkdtemp(prefix='exceldownload-bench-')
+        os.environ['TRAC_TEST_DB_URI'] = \
+            'sqlite:' + os.path.join(tempdir, 'trac.db')
+    results = []
+    regressions = []
+    try:
+        for count in options.tickets:
+            env = _create_env(options)
+            start = time.time()
+            report_id = _populate(env, options, count)
+            env.shutdown()
+            print '# %d tickets generated in %.2fs' % (count,
+                                                       time.time() - start)
+            for format in options.formats:
+                for export in options.exports:
+                    case = {'export': export, 'format': format,
+                            'tickets': count}
+                    result = _run(options, case, report_id)
+                    _print_result(result, baseline)
+                    results.append(result)
+                    if _is_regression(result,
+                                      baseline.get(_case_name(result)),
+                                      options.tolerance):
+                        regressions.append(_case_name(result))
+    finally:
+        if tempdir:
+            del os.environ['TRAC_TEST_DB_URI']
+            shutil.rmtree(tempdir)
+
+    if options.save_baseline:
+        f = open(options.save_baseline, 'w')
+        try:
+            json.dump({'python': sys.version.split()[0],
+                       'results': dict((_case_name(result), result)
+                                       for result in results)},
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if regressions:
+        print '# regressions: %s' % ', '.join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
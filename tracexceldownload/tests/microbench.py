@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark of the primitives which the writers call per cell.
+
+Usage::
+
+    python -m tracexceldownload.tests.microbench [--values 1000]
+        [--formats xls,xlsx,xlsx-builtin] [--save-baseline FILE]
+        [--baseline FILE]
+
+Each primitive is timed with `timeit` over the values of the
+distributions, and the best time per value is reported in nanoseconds,
+including the loop and the call.
+"""
+
+import argparse
+import json
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import FixedOffset, timezone, utc
+
+from tracexceldownload.api import get_workbook_writer
+
+
+_text_distributions = ('ascii', 'cjk', 'control', 'multiline', 'numeric')
+
+# (name, distributions, function returning the callable of the primitive
+# from the workbook writer and the worksheet writer)
+_primitives = (
+    ('overhead', ('ascii',), lambda book, sheet: lambda value: None),
+    ('get_metrics', _text_distributions,
+     lambda book, sheet: book.get_metrics),
+    ('_normalize_text', _text_distributions,
+     lambda book, sheet: sheet._normalize_text),
+    ('_set_col_width', ('widths',),
+     lambda book, sheet: lambda value: sheet._set_col_width(*value)),
+    ('_convert_value', ('datetime',),
+     lambda book, sheet: lambda value: sheet._convert_value(value,
+                                                            '[datetime]')),
+    ('_resolve_style', ('styles',),
+     lambda book, sheet: sheet._resolve_style),
+)
+
+_ascii_chars = map(unichr, range(0x61, 0x7b)) + [u' '] * 5
+_cjk_chars = map(unichr, range(0x3041, 0x3097) + range(0x4e00, 0x4f00))
+_control_chars = map(unichr, range(0x00, 0x09) + range(0x0b, 0x20)) + \
+                 [u'\ufffe', u'\uffff']
+_numeric_texts = (u'0', u'42', u'-4.5', u'+1', u'3.14159', u'1e10',
+                  u' 123 ', u'nan', u'-inf', u'.5', u'12abc', u'1-2-3')
+_styles = ('*', 'thead', 'header', '[datetime]', '[date]', 'id', 'summary',
+           'summary:change', 'milestone:change', 'unknown', 'unknown:change')
+_timezones = (utc, FixedOffset(540, 'UTC+9'), timezone('Asia/Tokyo'),
+              timezone('America/New_York'), timezone('Europe/London'))
+
+
+def _text(rnd, chars, min, max):
+    return u''.join(rnd.choice(chars)
+                    for idx in xrange(rnd.randint(min, max)))
+
+
+def _generate(name, count):
+    rnd = random.Random(name)
+    if name == 'ascii':
+        return [_text(rnd, _ascii_chars, 5, 40) for idx in xrange(count)]
+    if name == 'cjk':
+        return [_text(rnd, _cjk_chars, 5, 40) for idx in xrange(count)]
+    if name == 'control':
+        return [_text(rnd, _ascii_chars, 5, 20) +
+                _text(rnd, _control_chars, 1, 3) +
+                _text(rnd, _ascii_chars, 5, 20) for idx in xrange(count)]
+    if name == 'multiline':
+        return [u'\r\n'.join(_text(rnd, _ascii_chars + _cjk_chars, 40, 80) +
+                             u' ' * rnd.randint(0, 3)
+                             for line in xrange(rnd.randint(20, 50)))
+                for idx in xrange(count)]
+    if name == 'numeric':
+        return [rnd.choice(_numeric_texts) for idx in xrange(count)]
+    if name == 'widths':
+        return [(rnd.randint(0, 19), rnd.uniform(1, 60))
+                for idx in xrange(count)]
+    if name == 'datetime':
+        start = datetime(2016, 1, 1, tzinfo=utc)
+        values = []
+        for idx in xrange(count):
+            value = start + \
+                    timedelta(seconds=rnd.randint(0, 10 * 365 * 86400),
+                              microseconds=rnd.randint(0, 999999))
+            tz = rnd.choice(_timezones)
+            if hasattr(tz, 'normalize'):
+                value = tz.normalize(value.astimezone(tz))
+            else:
+                value = value.astimezone(tz)
+            values.append(value)
+        return values
+    if name == 'styles':
+        return [rnd.choice(_styles) for idx in xrange(count)]
+    raise ValueError(name)
+
+
+def _create_writers(format, locale):
+    env = EnvironmentStub()
+    env.config.set('exceldownload', 'format', format)
+    kwargs = {'tz': timezone('Europe/Paris')}
+    if locale:
+        # the writers use only the language of the locale
+        try:
+            from babel import Locale
+        except ImportError:
+            kwargs['locale'] = locale
+        else:
+            kwargs['locale'] = Locale.parse(locale)
+    req = MockRequest(env, **kwargs)
+    book = get_workbook_writer(env, req)
+    return book, book.create_sheet('Microbench')
+
+
+def _time(func, values, number, repeat):
+    def run():
+        for value in values:
+            func(value)
+    best = min(timeit.Timer(run).repeat(repeat, number))
+    return best / (number * len(values)) * 1e9
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark of the primitives of the writers.")
+    parser.add_argument('--formats', default='xls,xlsx,xlsx-builtin',
+                        help="comma-separated formats "
+                             "(default: %(default)s)")
+    parser.add_argument('--primitives',
+                        default=','.join(p[0] for p in _primitives),
+                        help="comma-separated primitives "
+                             "(default: %(default)s)")
+    parser.add_argument('--values', type=int, default=1000,
+                        help="number of values per distribution "
+                             "(default: %(default)s)")
+    parser.add_argument('--number', type=int, default=10,
+                        help="number of loops over the values per timing "
+                             "(default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of timings, the best is reported "
+                             "(default: %(default)s)")
+    parser.add_argument('--locale', metavar='LOCALE',
+                        help="locale of the request, e.g. `ja` for the "
+                             "double width of ambiguous characters")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare with the results saved in FILE")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="save the results to FILE")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="ratio of the slowdown reported as a "
+                             "regression (default: %(default)s)")
+    options = parser.parse_args(argv)
+    options.formats = _split(options.formats)
+    options.primitives = _split(options.primitives)
+    names = set(p[0] for p in _primitives)
+    for name in options.primitives:
+        if name not in names:
+            parser.error('invalid primitive: %s' % name)
+    return options
+
+
+def main(argv=None):
+    options = _parse_args(argv)
+    baseline = {}
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)['results']
+        finally:
+            f.close()
+
+    values = {}
+    results = {}
+    regressions = []
+    for format in options.formats:
+        book, sheet = _create_writers(format, options.locale)
+        for name, distributions, get_func in _primitives:
+            if name not in options.primitives:
+                continue
+            func = get_func(book, sheet)
+            for distribution in distributions:
+                if distribution not in values:
+                    values[distribution] = _generate(distribution,
+                                                     options.values)
+                key = '%s/%s/%s' % (name, format, distribution)
+                ns = _time(func, values[distribution], options.number,
+                           options.repeat)
+                results[key] = ns
+                line = '%-44s %10.1f ns' % (key, ns)
+                base = baseline.get(key)
+                if base:
+                    line += ' %+7.1f%%' % ((ns / base - 1) * 100)
+                    if name != 'overhead' and \
+                            ns > base * (1 + options.tolerance):
+                        regressions.append(key)
+                print line
+
+    if options.save_baseline:
+        f = open(options.save_baseline, 'w')
+        try:
+            json.dump({'python': sys.version.split()[0], 'results': results},
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if regressions:
+        print '# regressions: %s' % ', '.join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
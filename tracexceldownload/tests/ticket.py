@@ -1,8 +1,21 @@
 # -*- coding: utf-8 -*-
 
+from Queue import Queue
 from datetime import datetime, timedelta
+import io
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
 import unittest
+import zipfile
 
+from trac.core import Component, TracError, implements
+from trac.db.util import ConnectionWrapper
+from trac.perm import IPermissionPolicy, PermissionError
 from trac.test import EnvironmentStub, MockRequest
 from trac.ticket.model import Ticket
 from trac.ticket.query import Query
@@ -10,7 +23,31 @@ from trac.ticket.report import ReportModule
 from trac.util.datefmt import utc
 from trac.web.api import RequestDone
 
-from tracexceldownload.ticket import ExcelTicketModule, ExcelReportModule
+from tracexceldownload.api import (ExcelDownloadConfig, ServerCursor,
+                                   ZipfileWorksheetWriter,
+                                   get_workbook_writer)
+from tracexceldownload.job import (ExcelDownloadJobModule, _WorkerPool,
+                                   _write_json)
+import tracexceldownload.ticket as ticket_module
+from tracexceldownload.ticket import (ExcelTicketModule, ExcelReportModule,
+                                      _HistoryPrefetcher, _TicketIdFilter)
+
+
+class OddTicketsPolicy(Component):
+
+    implements(IPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if action == 'TICKET_VIEW' and resource and \
+                resource.realm == 'ticket' and resource.id and \
+                int(resource.id) % 2:
+            return False
+
+
+class ImmediateWorkerPool(object):
+
+    def submit(self, fn):
+        fn()
 
 
 class AbstractExcelTicketTestCase(unittest.TestCase):
@@ -53,6 +90,40 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
 
     def tearDown(self):
         self.env.reset_db()
+        if hasattr(self, 'cache_dir'):
+            shutil.rmtree(self.cache_dir)
+        if hasattr(self, 'jobs_dir'):
+            shutil.rmtree(self.jobs_dir)
+
+    def _enable_cache(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env.config.set('exceldownload', 'cache_dir', self.cache_dir)
+        self.env.config.set('exceldownload', 'cache_size', '1')
+
+    def _convert_query_sheets(self, query_string):
+        """Return the cells as `(value, style)` and the column widths of
+        the sheets of the query including the history."""
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, query_string)
+        book = get_workbook_writer(self.env, req)
+        sheets = []
+        create_sheet = book.create_sheet
+        def create_sheet_recording(title):
+            writer = create_sheet(title)
+            rows = []
+            write_cells = writer._write_cells
+            def record_cells(cells):
+                rows.append([(value, style)
+                             for value, style, width, line in cells])
+                write_cells(cells)
+            writer._write_cells = record_cells
+            sheets.append((writer, rows))
+            return writer
+        book.create_sheet = create_sheet_recording
+        mod._convert_query(req, query, sheet_history=True, book=book)
+        book.dump(io.BytesIO())
+        return [(rows, dict(writer._col_widths)) for writer, rows in sheets]
 
     def test_ticket(self):
         mod = ExcelTicketModule(self.env)
@@ -76,6 +147,436 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
         self.assertEqual(self._magic_number, content[:8])
         self.assertEqual(self._mimetype, mimetype)
 
+    def test_query_width_sample_rows(self):
+        query_string = 'status=!closed&max=9'
+        expected = self._convert_query_sheets(query_string)
+        self.env.config.set('exceldownload', 'width_sample_rows', '1000')
+        self.assertEqual(expected, self._convert_query_sheets(query_string))
+        self.env.config.set('exceldownload', 'width_sample_rows', '3')
+        sheets = self._convert_query_sheets(query_string)
+        self.assertEqual([rows for rows, widths in expected],
+                         [rows for rows, widths in sheets])
+        for (rows1, widths1), (rows2, widths2) in zip(expected, sheets):
+            if self._format == 'xls':
+                # the widths are determined from all rows
+                self.assertEqual(widths1, widths2)
+                continue
+            # the widths are determined from the leading rows
+            self.assertNotEqual(widths1, widths2)
+            self.assertEqual(sorted(widths1), sorted(widths2))
+            for idx, width in widths2.iteritems():
+                self.assertTrue(width <= widths1[idx])
+
+    def test_query_fetch_batch_size(self):
+        query_string = 'status=!closed&max=0'
+        expected = self._convert_query_sheets(query_string)
+        self.env.config.set('exceldownload', 'fetch_batch_size', '3')
+        sheets = self._convert_query_sheets(query_string)
+        # column headers and ticket creation of 20 tickets
+        self.assertEqual(1 + 20, len(sheets[1][0]))
+        self.assertEqual(expected, sheets)
+
+    def test_query_temporary_table(self):
+        query_string = 'id=1,3,5,7,9,11,13&max=0'
+        expected = self._convert_query_sheets(query_string)
+        tables = []
+        create_table = _TicketIdFilter.__dict__['_create_table']
+        def create_table_recording(self, tkt_ids):
+            create_table(self, tkt_ids)
+            tables.append(self.table)
+        saved_max_terms = _TicketIdFilter.max_terms
+        _TicketIdFilter.max_terms = 2
+        _TicketIdFilter._create_table = create_table_recording
+        try:
+            sheets = self._convert_query_sheets(query_string)
+        finally:
+            _TicketIdFilter.max_terms = saved_max_terms
+            _TicketIdFilter._create_table = create_table
+        self.assertNotEqual([], tables)
+        self.assertNotIn(None, tables)
+        # header, column headers and 7 tickets
+        self.assertEqual(9, len(sheets[0][0]))
+        self.assertEqual(expected, sheets)
+
+    def test_ticket_id_filter_close_error(self):
+        id_filter = _TicketIdFilter(self.env, range(1, 400, 2))
+        table = id_filter.table
+        self.assertNotEqual(None, table)
+        # dropping the table fails
+        id_filter.table = 'tracexceldownload_nonexistent'
+        id_filter.close()
+        self.assertEqual(None, id_filter.table)
+        self.env.db_transaction('DROP TABLE %s' % table)
+
+    def test_ticket_id_filter_create_error(self):
+        class uuid(object):
+            hex = '0' * 32
+        table = 'tracexceldownload_ids_' + uuid.hex[:16]
+        self.env.db_transaction('CREATE TEMPORARY TABLE %s (id integer)' %
+                                table)
+        saved_uuid4 = ticket_module.uuid4
+        ticket_module.uuid4 = uuid
+        try:
+            # creating the table fails and the conditions are used
+            id_filter = _TicketIdFilter(self.env, range(1, 400, 2))
+        finally:
+            ticket_module.uuid4 = saved_uuid4
+            self.env.db_transaction('DROP TABLE %s' % table)
+        self.assertEqual(None, id_filter.table)
+        self.assertEqual([(id,) for id in xrange(1, 21, 2)],
+                         self.env.db_query('SELECT id FROM ticket WHERE %s '
+                                           'ORDER BY id' % id_filter('id')))
+        id_filter.close()
+
+    def test_query_fine_grained_permissions(self):
+        self.env.enable_component(OddTicketsPolicy)
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, DefaultPermissionPolicy')
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env, authname='anonymous')
+        query = Query.from_string(self.env, 'status=!closed&max=0')
+        book = mod._convert_query(req, query, sheet_history=True)
+        # header, column headers and even tickets
+        self.assertEqual(2 + 10, book.sheets[0].row_idx)
+        # column headers and ticket creation of even tickets
+        self.assertEqual(1 + 10, book.sheets[1].row_idx)
+
+    def test_query_max_rows(self):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=0')
+        book = get_workbook_writer(self.env, req)
+        create_sheet = book.create_sheet
+        def create_sheet_max_rows(title):
+            writer = create_sheet(title)
+            writer.MAX_ROWS = 8
+            return writer
+        book.create_sheet = create_sheet_max_rows
+        mod._convert_query(req, query, book=book)
+        # header, column headers and 5 tickets in each sheet
+        self.assertEqual([7] * 4, [sheet.row_idx for sheet in book.sheets])
+        book.dump(io.BytesIO())
+
+    def test_query_server_cursor(self):
+        query_string = 'status=!closed&max=0'
+        expected = self._convert_query_sheets(query_string)
+        self.env.config.set('exceldownload', 'server_cursor', 'enabled')
+        self.env.config.set('exceldownload', 'server_cursor_fetch_size', '3')
+        sheets = self._convert_query_sheets(query_string)
+        # header, column headers and 20 tickets
+        self.assertEqual(2 + 20, len(sheets[0][0]))
+        self.assertEqual(expected, sheets)
+
+        cnx = self.env.get_read_db()
+        while isinstance(cnx, ConnectionWrapper):
+            cnx = cnx.cnx
+        cursor = ServerCursor(cnx.cursor(), 3)
+        try:
+            cursor.execute("SELECT id FROM ticket ORDER BY id")
+            self.assertEqual([(1,), (2,)], cursor.fetchmany(2))
+            self.assertEqual((3,), cursor.fetchone())
+            self.assertEqual([(id,) for id in xrange(4, 21)], list(cursor))
+            self.assertEqual([], cursor.fetchmany())
+        finally:
+            cursor.close()
+
+    def test_query_concurrent_history(self):
+        prefetcher = _HistoryPrefetcher(self.env, 3)
+        for id in (2, 4, 999, 6, 8, 10, 12, 14):
+            prefetcher.append(id)
+        tickets = list(prefetcher)
+        self.assertEqual([2, 4, 6, 8, 10, 12, 14],
+                         [ticket.id for ticket in tickets])
+        self.assertEqual('Summary 4', tickets[1]['summary'])
+
+        self.env.config.set('exceldownload', 'concurrent_history', 'enabled')
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=0')
+        book = mod._convert_query(req, query, sheet_history=True)
+        # header, column headers and tickets
+        self.assertEqual(2 + 20, book.sheets[0].row_idx)
+        # column headers and ticket creation
+        self.assertEqual(1 + 20, book.sheets[1].row_idx)
+
+    def test_query_compress_processes(self):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=0')
+        content1, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                 'excel-history')
+        self.env.config.set('exceldownload', 'compress_processes', '2')
+        saved_chunk_rows = ZipfileWorksheetWriter._process_chunk_rows
+        ZipfileWorksheetWriter._process_chunk_rows = 3
+        try:
+            content2, mimetype = mod.convert_content(req, self._mimetype,
+                                                     query, 'excel-history')
+            if self._format == 'xlsx-builtin':
+                # the rows are compressed in the thread after the pool is
+                # closed
+                book = get_workbook_writer(self.env, req)
+                self.assertNotEqual(None, book.pool)
+                book.pool = multiprocessing.Pool(1)
+                book.pool.close()
+                mod._convert_query(req, query, sheet_history=True, book=book)
+                out = io.BytesIO()
+                book.dump(out)
+                content3 = out.getvalue()
+        finally:
+            ZipfileWorksheetWriter._process_chunk_rows = saved_chunk_rows
+        self.assertEqual(self._magic_number, content2[:8])
+        if self._format == 'xlsx-builtin':
+            archive1 = zipfile.ZipFile(io.BytesIO(content1))
+            for content in (content2, content3):
+                archive2 = zipfile.ZipFile(io.BytesIO(content))
+                self.assertEqual(None, archive2.testzip())
+                for name in archive1.namelist():
+                    self.assertEqual(archive1.read(name),
+                                     archive2.read(name))
+
+    def test_query_compression(self):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=0')
+        content1, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                 'excel-history')
+        self.env.config.set('exceldownload', 'compression_auto_rows', '5')
+        for compression in ('auto', 'fast', 'best', 'store'):
+            self.env.config.set('exceldownload', 'compression', compression)
+            content2, mimetype = mod.convert_content(req, self._mimetype,
+                                                     query, 'excel-history')
+            self.assertEqual(self._magic_number, content2[:8])
+            if self._format == 'xls':
+                continue
+            archive1 = zipfile.ZipFile(io.BytesIO(content1))
+            archive2 = zipfile.ZipFile(io.BytesIO(content2))
+            self.assertEqual(None, archive2.testzip())
+            for name in archive1.namelist():
+                self.assertEqual(archive1.read(name), archive2.read(name))
+            if compression == 'store':
+                self.assertEqual(set([zipfile.ZIP_STORED]),
+                                 set(info.compress_type
+                                     for info in archive2.infolist()))
+
+    def test_query_chunked(self):
+        self.env.config.set('exceldownload', 'download_mode', 'chunked')
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=9')
+        try:
+            mod.convert_content(req, self._mimetype, query, 'excel-history')
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = req.response_sent.getvalue()
+            self.assertEqual(self._magic_number, content[:8])
+            self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
+            self.assertNotIn('Content-Length', req.headers_sent)
+
+    def test_query_spooled(self):
+        self.env.config.set('exceldownload', 'download_mode', 'spooled')
+        self.env.config.set('exceldownload', 'spool_max_size', '1')
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=9')
+        try:
+            mod.convert_content(req, self._mimetype, query, 'excel-history')
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = ''.join(req._response)
+            self.assertEqual(self._magic_number, content[:8])
+            self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
+            self.assertEqual(str(len(content)),
+                             req.headers_sent['Content-Length'])
+
+    def test_query_cache(self):
+        self._enable_cache()
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=9')
+        content1, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                 'excel')
+        content2, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                 'excel')
+        self.assertEqual(self._magic_number, content1[:8])
+        self.assertEqual(content1, content2)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        ticket = Ticket(self.env, 1)
+        ticket['summary'] = 'Modified'
+        ticket.save_changes('admin', 'comment')
+        content3, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                 'excel')
+        self.assertEqual(self._magic_number, content3[:8])
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_query_cache_relative_dates(self):
+        self._enable_cache()
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'changetime=-1w..&max=9')
+        content, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                'excel')
+        self.assertEqual(self._magic_number, content[:8])
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_report_cache_key(self):
+        self._enable_cache()
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            for title, sql in (('Milestones',
+                                'SELECT t.id AS ticket, m.due '
+                                'FROM ticket t, milestone m '
+                                'WHERE m.name=t.milestone'),
+                               ('Reports', 'SELECT id, title FROM report'),
+                               ('Week', "SELECT id AS ticket FROM ticket "
+                                        "WHERE changetime > (strftime('%s',"
+                                        "'now') - 604800) * 1000000"),
+                               ('Today', 'SELECT id AS ticket FROM ticket '
+                                         'WHERE changetime > '
+                                         'CURRENT_TIMESTAMP -- now')):
+                cursor.execute("INSERT INTO report (title,query,description) "
+                               "VALUES (%s,%s,%s)", (title, sql, ''))
+            self.report_id = db.get_last_id(cursor, 'report')
+        mod = ExcelReportModule(self.env)
+
+        def get_key(id):
+            req = MockRequest(self.env, args={'id': str(id)})
+            return mod._get_cache_key(req)
+
+        key1 = get_key(self.report_id - 3)
+        self.env.db_transaction("UPDATE milestone SET due=1 "
+                                "WHERE name='milestone1'")
+        key2 = get_key(self.report_id - 3)
+        self.env.db_transaction("UPDATE report SET description='modified' "
+                                "WHERE id=%s", (self.report_id - 3,))
+        key3 = get_key(self.report_id - 3)
+        self.assertEqual(3, len(set([key1, key2, key3])))
+        # other tables and the current time
+        self.assertEqual(None, get_key(self.report_id - 2))
+        self.assertEqual(None, get_key(self.report_id - 1))
+        self.assertEqual(None, get_key(self.report_id))
+        # the words in the strings and the comments
+        self.env.db_transaction("UPDATE report SET query=%s WHERE id=%s",
+                                ("SELECT id AS ticket, 'now: ' || summary "
+                                 "FROM ticket -- NOW()",
+                                 self.report_id - 1))
+        self.assertNotEqual(None, get_key(self.report_id - 1))
+
+    def test_report_cache(self):
+        self._enable_cache()
+        mod = ExcelReportModule(self.env)
+        report_mod = ReportModule(self.env)
+
+        def request():
+            req = MockRequest(self.env, path_info='/report/1',
+                              args={'id': '1', 'format': 'xls'})
+            self.assertTrue(report_mod.match_request(req))
+            return req
+
+        req = request()
+        self.assertEqual(report_mod, mod.pre_process_request(req, report_mod))
+        template, data, content_type = report_mod.process_request(req)
+        try:
+            mod.post_process_request(req, template, data, content_type)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content1 = ''.join(req._response)
+            self.assertEqual(self._magic_number, content1[:8])
+
+        req = request()
+        try:
+            mod.pre_process_request(req, report_mod)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content2 = ''.join(req._response)
+            self.assertEqual(content1, content2)
+            self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
+
+    def test_query_async(self):
+        self.jobs_dir = tempfile.mkdtemp()
+        self.env.config.set('exceldownload', 'jobs_dir', self.jobs_dir)
+        self.env.config.set('exceldownload', 'async_threshold', '5')
+        mod = ExcelTicketModule(self.env)
+        job_mod = ExcelDownloadJobModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=9')
+        try:
+            mod.convert_content(req, self._mimetype, query, 'excel')
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            self.assertEqual(['302 Found'], req.status_sent)
+        self.assertEqual(1, len(job_mod._jobs))
+        job = job_mod._jobs.values()[0]
+        for idx in xrange(100):
+            if job.status in ('done', 'failed'):
+                break
+            time.sleep(0.1)
+        self.assertEqual('done', job.status)
+
+        # another anonymous user
+        other_req = MockRequest(self.env,
+                                path_info='/exceldownload/job/%s' % job.id)
+        self.assertTrue(job_mod.match_request(other_req))
+        self.assertRaises(PermissionError, job_mod.process_request,
+                          other_req)
+
+        cookie = 'trac_session=%s' % req.session.sid
+        req = MockRequest(self.env, path_info='/exceldownload/job/%s' % job.id,
+                          cookie=cookie)
+        self.assertTrue(job_mod.match_request(req))
+        template, data, content_type = job_mod.process_request(req)
+        self.assertEqual('done', data['job']['status'])
+        req = MockRequest(self.env,
+                          path_info='/exceldownload/job/%s/download' % job.id,
+                          cookie=cookie)
+        self.assertTrue(job_mod.match_request(req))
+        try:
+            job_mod.process_request(req)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = ''.join(req._response)
+            self.assertEqual(self._magic_number, content[:8])
+            self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
+
+    def test_query_async_full(self):
+        self.jobs_dir = tempfile.mkdtemp()
+        self.env.config.set('exceldownload', 'jobs_dir', self.jobs_dir)
+        self.env.config.set('exceldownload', 'async_threshold', '5')
+        mod = ExcelTicketModule(self.env)
+        job_mod = ExcelDownloadJobModule(self.env)
+        # no worker threads take the jobs from the queue
+        job_mod._pool = _WorkerPool(self.env, 0)
+        job_mod._pool._queue = Queue(1)
+        job_mod._pool._queue.put(None)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed&max=9')
+        self.assertRaises(TracError, mod.convert_content, req,
+                          self._mimetype, query, 'excel')
+        self.assertEqual({}, job_mod._jobs)
+        self.assertEqual([], os.listdir(self.jobs_dir))
+
+    def test_query_async_stale(self):
+        self.jobs_dir = tempfile.mkdtemp()
+        self.env.config.set('exceldownload', 'jobs_dir', self.jobs_dir)
+        job_mod = ExcelDownloadJobModule(self.env)
+        process = subprocess.Popen(['true'])
+        process.wait()
+        id = '0123456789abcdef0123456789abcdef'
+        path = os.path.join(self.jobs_dir, '%s.json' % id)
+        meta = {'authname': 'anonymous', 'sid': None, 'filename': 'query',
+                'ext': 'xls', 'time': time.time(), 'host': None, 'pid': None}
+        _write_json(path, meta)
+        self.assertEqual('running', job_mod._get_job(id)['status'])
+        # the process generating the file has died
+        meta.update(host=socket.gethostname(), pid=process.pid)
+        _write_json(path, meta)
+        self.assertEqual('failed', job_mod._get_job(id)['status'])
+        # the timeout
+        meta.update(host=None, pid=None, time=time.time() - 7200)
+        _write_json(path, meta)
+        self.assertEqual('failed', job_mod._get_job(id)['status'])
+
     def test_report(self):
         mod = ExcelReportModule(self.env)
         req = MockRequest(self.env, path_info='/report/1',
@@ -92,6 +593,171 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
             self.assertEqual(self._magic_number, content[:8])
             self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
 
+    def test_report_async(self):
+        self.jobs_dir = tempfile.mkdtemp()
+        self.env.config.set('exceldownload', 'jobs_dir', self.jobs_dir)
+        self.env.config.set('exceldownload', 'async_threshold', '5')
+        mod = ExcelReportModule(self.env)
+        job_mod = ExcelDownloadJobModule(self.env)
+        # the job is run in the request thread, because the worker threads
+        # may use the pooled connection of another in-memory database
+        job_mod._pool = ImmediateWorkerPool()
+        report_mod = ReportModule(self.env)
+        # the report is submitted before it is rendered
+        req = MockRequest(self.env, path_info='/report/1',
+                          args={'id': '1', 'format': 'xls'})
+        self.assertTrue(report_mod.match_request(req))
+        try:
+            mod.pre_process_request(req, report_mod)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            self.assertEqual(['302 Found'], req.status_sent)
+        self.assertEqual(1, len(job_mod._jobs))
+        job = job_mod._jobs.values()[0]
+        self.assertEqual('done', job.status)
+        self.assertEqual(20, job.total)
+        # the small report is rendered
+        self.env.config.set('exceldownload', 'async_threshold', '100')
+        req = MockRequest(self.env, path_info='/report/1',
+                          args={'id': '1', 'format': 'xls'})
+        self.assertTrue(report_mod.match_request(req))
+        self.assertEqual(report_mod, mod.pre_process_request(req, report_mod))
+
+    def test_report_time_columns(self):
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            cursor.execute("INSERT INTO report (title,query,description) "
+                           "VALUES (%s,%s,%s)",
+                           ('Times', 'SELECT id AS ticket, time AS created, '
+                                     'changetime AS modified, '
+                                     'changetime AS datetime FROM ticket',
+                            ''))
+            self.report_id = db.get_last_id(cursor, 'report')
+        mod = ExcelReportModule(self.env)
+        req = MockRequest(self.env,
+                          path_info='/report/%d' % self.report_id,
+                          args={'id': str(self.report_id), 'format': 'xls'})
+        report_mod = ReportModule(self.env)
+        self.assertTrue(report_mod.match_request(req))
+        template, data, content_type = report_mod.process_request(req)
+        try:
+            mod.post_process_request(req, template, data, content_type)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = req.response_sent.getvalue()
+            self.assertEqual(self._magic_number, content[:8])
+
+        rows = self._read_cells(content)
+        idx = [row[0][0] if row else None for row in rows].index('Ticket')
+        self.assertEqual(20, len(rows) - idx - 1)
+        for row in rows[idx + 1:]:
+            self.assertEqual('"#"0', row[0][1])
+            ticket = Ticket(self.env, int(row[0][0]))
+            expected = [(ticket['time'], 'YYYY-MM-DD'),
+                        (ticket['changetime'], 'YYYY-MM-DD'),
+                        (ticket['changetime'], 'YYYY-MM-DD HH:MM:SS')]
+            for (value, number_format), (t, expected_format) in \
+                    zip(row[1:4], expected):
+                self.assertTrue(isinstance(value, datetime), repr(value))
+                self.assertEqual(expected_format, number_format)
+                self.assertTrue(abs(t.replace(tzinfo=None) - value) <
+                                timedelta(seconds=1))
+
+    def _read_cells(self, content):
+        """Return the rows of the first sheet as lists of `(value,
+        number_format)` of the cells."""
+        if self._format == 'xls':
+            try:
+                import xlrd
+            except ImportError:
+                raise unittest.SkipTest('xlrd is not installed')
+            book = xlrd.open_workbook(file_contents=content,
+                                      formatting_info=True)
+            sheet = book.sheet_by_index(0)
+            rows = []
+            for idx in xrange(sheet.nrows):
+                cells = []
+                for cell in sheet.row(idx):
+                    value = cell.value
+                    xf = book.xf_list[cell.xf_index]
+                    number_format = book.format_map[xf.format_key].format_str
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        value = xlrd.xldate.xldate_as_datetime(value,
+                                                               book.datemode)
+                    cells.append((value, number_format))
+                rows.append(cells)
+        else:
+            import openpyxl
+            book = openpyxl.load_workbook(io.BytesIO(content))
+            rows = [[(cell.value, cell.number_format) for cell in row
+                                                      if cell.value is not None]
+                    for row in book.worksheets[0].iter_rows()]
+        return rows
+
+    def test_report_direct(self):
+        self.env.enable_component(OddTicketsPolicy)
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, DefaultPermissionPolicy')
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            cursor.execute("INSERT INTO report (title,query,description) "
+                           "VALUES (%s,%s,%s)",
+                           ('Direct', 'SELECT milestone AS __group__, '
+                                      'id AS ticket, summary, reporter, '
+                                      'owner AS _owner, time AS created, '
+                                      'changetime AS datetime, '
+                                      'description AS _description_, '
+                                      'changetime AS modified_ '
+                                      'FROM ticket ORDER BY milestone, id',
+                            ''))
+            self.report_id = db.get_last_id(cursor, 'report')
+        mod = ExcelReportModule(self.env)
+        report_mod = ReportModule(self.env)
+        books = []
+        def send_report(req, filename, numrows, build):
+            book = get_workbook_writer(self.env, req)
+            rows = []
+            create_sheet = book.create_sheet
+            def create_sheet_recording(title):
+                writer = create_sheet(title)
+                write_cells = writer._write_cells
+                def record_cells(cells):
+                    rows.append([(value, style)
+                                 for value, style, width, line in cells])
+                    write_cells(cells)
+                writer._write_cells = record_cells
+                return writer
+            book.create_sheet = create_sheet_recording
+            build(req, book)
+            books.append(rows)
+        mod._send_report = send_report
+
+        for mode in ('rendered', 'direct'):
+            self.env.config.set('exceldownload', 'report_mode', mode)
+            req = MockRequest(self.env, authname='anonymous',
+                              path_info='/report/%d' % self.report_id,
+                              args={'id': str(self.report_id),
+                                    'format': 'xls'})
+            self.assertTrue(report_mod.match_request(req))
+            mod.pre_process_request(req, report_mod)
+            if mode == 'rendered':
+                template, data, content_type = \
+                    report_mod.process_request(req)
+                mod.post_process_request(req, template, data, content_type)
+        self.assertEqual(2, len(books))
+        rendered, direct = books
+        values = [value for row in rendered for value, style in row]
+        # the headers of the groups and the time columns
+        self.assertIn('milestone1 (5 matches)', values)
+        self.assertTrue(any(isinstance(value, (datetime, float))
+                            for row in rendered[3:] for value, style in row))
+        self.assertEqual(len(rendered), len(direct))
+        for idx, (row1, row2) in enumerate(zip(rendered, direct)):
+            self.assertEqual(row1, row2, 'row %d: %r != %r' %
+                                         (idx, row1, row2))
+
 
 class Excel2003TicketTestCase(AbstractExcelTicketTestCase):
 
@@ -108,8 +774,17 @@ class Excel2007TicketTestCase(AbstractExcelTicketTestCase):
     _magic_number = b'PK\x03\x04\x14\x00\x00\x00'
 
 
+class Excel2007BuiltinTicketTestCase(AbstractExcelTicketTestCase):
+
+    _format = 'xlsx-builtin'
+    _mimetype = 'application/' \
+                'vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    _magic_number = b'PK\x03\x04\x14\x00\x00\x00'
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Excel2003TicketTestCase))
     suite.addTest(unittest.makeSuite(Excel2007TicketTestCase))
+    suite.addTest(unittest.makeSuite(Excel2007BuiltinTicketTestCase))
     return suite
@@ -1,46 +1,60 @@
 # -*- coding: utf-8 -*-
 
-import inspect
+import copy
 import re
-import types
+import sys
+import threading
+from Queue import Full, Queue
 from datetime import datetime
-from itertools import chain, groupby
+from itertools import chain, groupby, izip
+from uuid import uuid4
 
 from trac.core import Component, implements
+from trac.db.api import DatabaseManager
 from trac.env import Environment
 from trac.mimeview.api import Context, IContentConverter
-from trac.resource import Resource, get_resource_url
+from trac.resource import Resource
 from trac.ticket.api import TicketSystem
 from trac.ticket.model import Ticket
 from trac.ticket.query import Query
-from trac.ticket.web_ui import TicketModule
-from trac.util import Ranges
-from trac.util.text import empty, unicode_urlencode
-from trac.web.api import IRequestFilter, RequestDone
+from trac.ticket.report import ReportModule, sub_vars
+from trac.util import Ranges, as_bool
+from trac.util.text import (empty, exception_to_unicode, to_unicode,
+                             unicode_urlencode)
+from trac.web.api import IRequestFilter
 from trac.web.chrome import Chrome, add_link
 try:
     from trac.util.datefmt import from_utimestamp
+    _to_utimestamp = long
 except ImportError:
     from datetime import timedelta
     from trac.util.datefmt import utc
     _epoc = datetime(1970, 1, 1, tzinfo=utc)
     from_utimestamp = lambda ts: _epoc + timedelta(seconds=ts or 0)
-
-from tracexceldownload.api import (get_excel_format, get_excel_mimetype,
-                                   get_workbook_writer)
+    _to_utimestamp = lambda ts: long(ts) * 1000000
+
+from tracexceldownload.api import (ExcelDownloadConfig, get_excel_format,
+                                   get_excel_mimetype, get_server_cursor,
+                                   get_workbook_writer,
+                                   has_fine_grained_permissions,
+                                   is_buffered_download, send_workbook,
+                                   send_workbook_file)
+from tracexceldownload.cache import ExcelDownloadCache
+from tracexceldownload.job import ExcelDownloadJobModule
 from tracexceldownload.translation import _, dgettext, dngettext
 
 
 if hasattr(Environment, 'get_read_db'):
     _get_db = lambda env: env.get_read_db()
+    _get_write_db = lambda env: DatabaseManager(env).get_connection()
 else:
-    _get_db = lambda env: env.get_db_cnx()
+    _get_db = _get_write_db = lambda env: env.get_db_cnx()
 
 
-def _tkt_id_conditions(column, tkt_ids):
+def _tkt_id_terms(tkt_ids):
     ranges = Ranges()
     ranges.appendrange(','.join(map(str, sorted(tkt_ids))))
-    condition = []
+    pairs = []
     tkt_ids = []
     for a, b in ranges.pairs:
         if a == b:
@@ -48,10 +62,294 @@ def _tkt_id_conditions(column, tkt_ids):
         elif a + 1 == b:
             tkt_ids.extend((a, b))
         else:
-            condition.append('%s BETWEEN %d AND %d' % (column, a, b))
-    if tkt_ids:
-        condition.append('%s IN (%s)' % (column, ','.join(map(str, tkt_ids))))
-    return ' OR '.join(condition)
+            pairs.append((a, b))
+    return pairs, tkt_ids
+
+
+class _TicketIdFilter(object):
+    """Build SQL conditions to filter the ticket ids. If the ids need too
+    many terms of `BETWEEN` and `IN`, the ids are loaded into a temporary
+    table instead of building a large SQL statement, unless the database
+    refuses to create it."""
+
+    max_terms = 100
+
+    def __init__(self, env, tkt_ids, temporary=True):
+        self.env = env
+        self.table = None
+        self._db = None
+        self._scheme = None
+        pairs, ids = _tkt_id_terms(tkt_ids)
+        if temporary and len(pairs) + len(ids) > self.max_terms:
+            self._create_table(tkt_ids)
+        self._conditions = pairs, ids
+
+    def __call__(self, column):
+        if self.table:
+            return '%s IN (SELECT id FROM %s)' % (column, self.table)
+        pairs, ids = self._conditions
+        condition = ['%s BETWEEN %d AND %d' % (column, a, b)
+                     for a, b in pairs]
+        if ids:
+            condition.append('%s IN (%s)' % (column, ','.join(map(str, ids))))
+        return ' OR '.join(condition)
+
+    def close(self):
+        if self.table:
+            table = self.table
+            self.table = None
+            # DROP TABLE commits the transaction on MySQL
+            temporary = 'TEMPORARY ' if self._scheme == 'mysql' else ''
+            try:
+                cursor = self._db.cursor()
+                cursor.execute('DROP %sTABLE %s' % (temporary, table))
+            except Exception, e:
+                # e.g. the transaction has been aborted by the error which
+                # is raised to the caller, on PostgreSQL. The temporary
+                # table is dropped at the end of the session.
+                self.env.log.warning("Failed to drop table %s: %s", table,
+                                     exception_to_unicode(e))
+
+    def _create_table(self, tkt_ids):
+        table = 'tracexceldownload_ids_%s' % uuid4().hex[:16]
+        # the connection of the thread, which the queries of the filter
+        # use, without the check for read-only statements
+        db = _get_write_db(self.env)
+        scheme = DatabaseManager(self.env).connection_uri.split(':', 1)[0]
+        # a failed statement aborts the transaction on PostgreSQL
+        savepoint = scheme == 'postgres'
+        cursor = db.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT %s' % table)
+            cursor.execute('CREATE TEMPORARY TABLE %s '
+                           '(id integer PRIMARY KEY)' % table)
+            cursor.executemany('INSERT INTO %s (id) VALUES (%%s)' % table,
+                               [(id,) for id in sorted(set(tkt_ids))])
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT %s' % table)
+        except Exception, e:
+            # e.g. no privilege to create temporary tables or read-only
+            # database, the ids are filtered with the conditions
+            self.env.log.warning("Failed to create temporary table %s: %s",
+                                 table, exception_to_unicode(e))
+            if savepoint:
+                try:
+                    cursor.execute('ROLLBACK TO SAVEPOINT %s' % table)
+                except Exception, e:
+                    self.env.log.warning("Failed to roll back to savepoint "
+                                         "%s: %s", table,
+                                         exception_to_unicode(e))
+            return
+        self.table = table
+        self._db = db
+        self._scheme = scheme
+
+
+def _merge_join(items, rows):
+    """Generate `(item, matched)` pairs from `(id, item)` pairs and `rows`
+    starting with the id, both ordered by the id. `matched` is the list of
+    the rows of the item."""
+    rows = iter(rows)
+    row = next(rows, None)
+    for id, item in items:
+        matched = []
+        while row is not None and row[0] <= id:
+            if row[0] == id:
+                matched.append(row)
+            row = next(rows, None)
+        yield item, matched
+
+
+def _group_changelog(rows):
+    """Generate the changes from `ticket_change` rows of a ticket ordered
+    by time, grouped like `TicketModule.grouped_changelog_entries` does for
+    the permanent changes. `fields` of the changes has the old values."""
+    for t, rows in groupby(rows, lambda row: row[1]):
+        author = None
+        comment = ''
+        fields = {}
+        for id, t, row_author, field, old, new in rows:
+            old = old or ''
+            new = new or ''
+            if author is None and not field.startswith('_'):
+                author = row_author
+            if field == 'comment':
+                comment = new
+                author = row_author
+            elif field.startswith('_comment'):
+                pass
+            elif (old or new) and old != new:
+                fields[field] = old
+        yield {'date': from_utimestamp(t), 'author': author or '',
+               'comment': comment, 'fields': fields}
+
+
+class _AuthorFormatter(object):
+    """Format the authors and the lists of email addresses once for each
+    value during an export."""
+
+    def __init__(self, env, req):
+        self.chrome = Chrome(env)
+        self.req = req
+        self.fine_grained = not self.chrome.show_email_addresses and \
+                            has_fine_grained_permissions(env)
+        self._authors = {}
+        self._emails = {}
+
+    def format_author(self, value):
+        try:
+            return self._authors[value]
+        except KeyError:
+            pass
+        formatted = self.chrome.format_author(self.req, value)
+        self._authors[value] = formatted
+        return formatted
+
+    def format_emails(self, context, value):
+        if self.fine_grained:
+            # the obfuscation can be decided for each ticket
+            key = (value, 'EMAIL_VIEW' in context.perm(context.resource))
+        else:
+            key = value
+        try:
+            return self._emails[key]
+        except KeyError:
+            pass
+        formatted = self.chrome.format_emails(context, value)
+        self._emails[key] = formatted
+        return formatted
+
+
+def _get_tickets_freshness(env):
+    """Return values which are changed when any ticket is created,
+    modified or deleted, or ticket fields are changed."""
+    db = _get_db(env)
+    cursor = db.cursor()
+    cursor.execute("SELECT MAX(changetime),COUNT(*) FROM ticket")
+    values = list(cursor.fetchone())
+    values.extend(sorted(env.config.options('ticket-custom')))
+    return values
+
+
+# the queries returning values which are changed with the contents of the
+# tables read by reports, `None` for the tables of `_get_tickets_freshness`
+_table_freshness_queries = {
+    'ticket': None,
+    'ticket_custom': None,
+    'ticket_change': "SELECT MAX(time),COUNT(*) FROM ticket_change",
+    'wiki': "SELECT MAX(time),COUNT(*) FROM wiki",
+    'enum': "SELECT type,name,value FROM enum ORDER BY type,name",
+    'component': "SELECT name,owner,description FROM component "
+                 "ORDER BY name",
+    'milestone': "SELECT name,due,completed,description FROM milestone "
+                 "ORDER BY name",
+    'version': "SELECT name,time,description FROM version ORDER BY name",
+}
+
+
+def _get_tables_freshness(env, tables):
+    """Return values which are changed when the contents of `tables` are
+    changed, or `None` if unknown for any of the tables."""
+    if any(table not in _table_freshness_queries for table in tables):
+        return None
+    values = _get_tickets_freshness(env)
+    db = _get_db(env)
+    cursor = db.cursor()
+    for table in sorted(tables):
+        sql = _table_freshness_queries[table]
+        if sql:
+            cursor.execute(sql)
+            values.append(table)
+            values.extend(cursor.fetchall())
+    return values
+
+
+_sql_comments_re = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_sql_tokens_re = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|\w+|\S")
+_sql_clause_keywords = frozenset([
+    'cross', 'except', 'full', 'group', 'having', 'inner', 'intersect',
+    'join', 'left', 'limit', 'natural', 'on', 'order', 'outer', 'right',
+    'union', 'using', 'where', 'window'])
+# functions and literals of the current time, e.g. `strftime('%s','now')`
+# of SQLite, `NOW()` and `'today'::date` of PostgreSQL and `CURDATE()` of
+# MySQL
+_sql_current_time_tokens = frozenset([
+    'clock_timestamp', 'curdate', 'current_date', 'current_time',
+    'current_timestamp', 'curtime', 'getdate', 'localtime',
+    'localtimestamp', 'now', 'statement_timestamp', 'sysdate',
+    'timeofday', 'transaction_timestamp', 'unix_timestamp', 'utc_date',
+    'utc_time', 'utc_timestamp', "'now'", "'today'", "'tomorrow'",
+    "'yesterday'"])
+
+
+def _get_sql_tokens(sql):
+    """Return the lowercased tokens of `sql` without the comments."""
+    return [token.lower()
+            for token in _sql_tokens_re.findall(_sql_comments_re.sub(' ',
+                                                                      sql))]
+
+
+def _has_current_time(tokens):
+    """Return whether the SQL tokens refer to the current time."""
+    return any(token in _sql_current_time_tokens for token in tokens)
+
+
+def _get_sql_tables(tokens):
+    """Return the names of the tables after `FROM` and `JOIN` in the SQL
+    tokens. Subqueries are scanned by their own `FROM`."""
+    tables = set()
+    for idx, token in enumerate(tokens):
+        if token not in ('from', 'join'):
+            continue
+        idx += 1
+        while idx < len(tokens) and tokens[idx] != '(':
+            tables.add(tokens[idx].strip('"'))
+            idx += 1
+            if idx < len(tokens) and tokens[idx] == 'as':
+                idx += 1
+            if idx < len(tokens) and tokens[idx][0].isalnum() and \
+                    tokens[idx] not in _sql_clause_keywords:
+                idx += 1  # alias
+            if token != 'from' or idx >= len(tokens) or tokens[idx] != ',':
+                break
+            idx += 1
+    return tables
+
+
+_iso_date_re = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def _has_relative_dates(query):
+    """Return `True` if the query has constraints of time fields which are
+    not absolute dates in ISO 8601, e.g. `-1w..` or `today`."""
+    names = set(field['name'] for field in query.fields
+                                if field['type'] == 'time')
+    for constraints in query.constraints:
+        for name, values in constraints.iteritems():
+            if name not in names:
+                continue
+            for value in values:
+                for token in value.split('..'):
+                    token = token.strip()
+                    if token and not _iso_date_re.match(token):
+                        return True
+    return False
+
+
+def _report_cell_value(value):
+    """Return the value displayed in the cell like `ReportModule` does."""
+    return '0' if value == 0 else to_unicode(value) if value else ''
+
+
+def _report_value(value):
+    """Return the value written to the cell for the value from the
+    cursor."""
+    if value is None:
+        return ''
+    if isinstance(value, (basestring, int, long, float)):
+        return value
+    return to_unicode(value)
 
 
 class BulkFetchTicket(Ticket):
@@ -66,55 +364,71 @@ class BulkFetchTicket(Ticket):
         std_fields = [f['name'] for f in fields if not f.get('custom')]
         time_fields = [f['name'] for f in fields if f['type'] == 'time']
         custom_fields = set(f['name'] for f in fields if f.get('custom'))
-        cursor = db.cursor()
         tickets = {}
+        id_filter = _TicketIdFilter(env, tkt_ids)
+        try:
+            cls._fetch(db, id_filter, tickets, std_fields, time_fields,
+                       custom_fields)
+        finally:
+            id_filter.close()
 
-        cursor.execute('SELECT %s,id FROM ticket WHERE %s' %
-                       (','.join(std_fields),
-                        _tkt_id_conditions('id', tkt_ids)))
-        for row in cursor:
-            id = row[-1]
+        return dict((id, cls(env, id, values=values, changes=changes,
+                             fields=fields, time_fields=time_fields))
+                    for id, (values, changes) in tickets.iteritems())
+
+    @classmethod
+    def _fetch(cls, db, id_filter, tickets, std_fields, time_fields,
+               custom_fields):
+        # the result sets are bounded by the batch of the ids, so the
+        # cursors of `db` are used rather than server cursors. The custom
+        # fields are merged while both cursors advance by id.
+        ticket_cursor = db.cursor()
+        ticket_cursor.execute('SELECT id,%s FROM ticket WHERE %s '
+                              'ORDER BY id' %
+                              (','.join(std_fields), id_filter('id')))
+        custom_cursor = db.cursor()
+        custom_cursor.execute('SELECT ticket,name,value FROM ticket_custom '
+                              'WHERE %s ORDER BY ticket' %
+                              id_filter('ticket'))
+        for row, custom_rows in _merge_join(((row[0], row)
+                                             for row in ticket_cursor),
+                                            custom_cursor):
             values = {}
-            for idx, field in enumerate(std_fields):
-                value = row[idx]
+            for field, value in izip(std_fields, row[1:]):
                 if field in time_fields:
                     value = from_utimestamp(value)
                 elif value is None:
                     value = empty
                 values[field] = value
-            tickets[id] = (values, [])  # values, changelog
-
-        cursor.execute('SELECT ticket,name,value FROM ticket_custom '
-                       'WHERE %s ORDER BY ticket' %
-                       _tkt_id_conditions('ticket', tkt_ids))
-        for id, rows in groupby(cursor, lambda row: row[0]):
-            if id not in tickets:
-                continue
-            values = {}
-            for id, name, value in rows:
+            for id, name, value in custom_rows:
                 if name in custom_fields:
-                    if value is None:
-                        value = empty
-                    values[name] = value
-            tickets[id][0].update(values)
-
-        cursor.execute('SELECT ticket,time,author,field,oldvalue,newvalue '
-                       'FROM ticket_change WHERE %s ORDER BY ticket,time' %
-                       _tkt_id_conditions('ticket', tkt_ids))
-        for id, rows in groupby(cursor, lambda row: row[0]):
+                    values[name] = empty if value is None else value
+            tickets[row[0]] = (values, [])  # values, changes
+
+        change_cursor = db.cursor()
+        change_cursor.execute('SELECT ticket,time,author,field,oldvalue,'
+                              'newvalue FROM ticket_change WHERE %s '
+                              'ORDER BY ticket,time' % id_filter('ticket'))
+        for id, rows in groupby(change_cursor, lambda row: row[0]):
             if id not in tickets:
                 continue
-            tickets[id][1].extend(
-                    (from_utimestamp(t), author, field, oldvalue or '',
-                     newvalue or '', 1)
-                    for id, t, author, field, oldvalue, newvalue in rows)
+            tickets[id][1].extend(_group_changelog(rows))
 
-        return dict((id, cls(env, id, values=values, changelog=changelog,
-                             fields=fields, time_fields=time_fields))
-                    for id, (values, changelog) in tickets.iteritems())
+    @classmethod
+    def iter_select(cls, env, tkt_ids, batch_size):
+        """Generate the tickets in order of `tkt_ids`, fetching
+        `batch_size` tickets at once. The missing tickets are skipped."""
+        batch_size = max(batch_size, 1)
+        for idx in xrange(0, len(tkt_ids), batch_size):
+            batch = tkt_ids[idx:idx + batch_size]
+            tickets = cls.select(env, batch)
+            for id in batch:
+                ticket = tickets.get(id)
+                if ticket is not None:
+                    yield ticket
 
     def __init__(self, env, tkt_id=None, db=None, version=None, values=None,
-                 changelog=None, fields=None, time_fields=None):
+                 changes=None, fields=None, time_fields=None):
         self.env = env
         if tkt_id is not None:
             tkt_id = int(tkt_id)
@@ -124,7 +438,7 @@ class BulkFetchTicket(Ticket):
         self.version = version
         self._values = values
         self.values = values.copy()
-        self._changelog = changelog
+        self.changes = changes
         self._old = {}
 
     @property
@@ -134,8 +448,80 @@ class BulkFetchTicket(Ticket):
     def _fetch_ticket(self, tkt_id, db=None):
         self.values = self._values.copy()
 
-    def get_changelog(self, when=None, db=None):
-        return self._changelog[:]
+
+class _HistoryPrefetcher(object):
+    """Fetch the tickets with the change history in a thread while the
+    ids are appended, in order to overlap the fetching with writing the
+    query sheet. Iterating generates the tickets in order of the ids after
+    all the ids are appended. The missing tickets are skipped."""
+
+    max_batches = 4
+
+    def __init__(self, env, batch_size):
+        self.env = env
+        self.batch_size = max(batch_size, 1)
+        self._batch = []
+        self._ids = Queue()
+        # the fetched batches waiting for the history sheet are limited
+        self._tickets = Queue(self.max_batches)
+        self._cancelled = False
+        thread = threading.Thread(target=self._run,
+                                  name='exceldownload-history')
+        thread.daemon = True
+        thread.start()
+
+    def append(self, id):
+        batch = self._batch
+        batch.append(id)
+        if len(batch) >= self.batch_size:
+            self._ids.put(batch)
+            self._batch = []
+
+    def __iter__(self):
+        if self._batch:
+            self._ids.put(self._batch)
+            self._batch = []
+        self._ids.put(None)
+        while True:
+            item = self._tickets.get()
+            if item is None:
+                break
+            batch, tickets, exc_info = item
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for id in batch:
+                ticket = tickets.get(id)
+                if ticket is not None:
+                    yield ticket
+
+    def cancel(self):
+        self._cancelled = True
+        self._ids.put(None)
+
+    def _run(self):
+        tid = threading.current_thread().ident
+        try:
+            while not self._cancelled:
+                batch = self._ids.get()
+                if batch is None:
+                    break
+                try:
+                    tickets = BulkFetchTicket.select(self.env, batch)
+                except Exception:
+                    self._put((batch, None, sys.exc_info()))
+                    return
+                self._put((batch, tickets, None))
+            self._put(None)
+        finally:
+            self.env.shutdown(tid)
+
+    def _put(self, item):
+        while not self._cancelled:
+            try:
+                self._tickets.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
 
 
 class ExcelTicketModule(Component):
@@ -154,23 +540,79 @@ class ExcelTicketModule(Component):
 
     def convert_content(self, req, mimetype, content, key):
         if key == 'excel':
-            return self._convert_query(req, content)
-        if key == 'excel-history':
+            filename = 'query'
+            kwargs = {}
+        elif key == 'excel-history':
             kwargs = {}
             if isinstance(content, Ticket):
+                filename = 't%d' % content.id
                 content = Query.from_string(self.env, 'id=%d' % content.id)
                 kwargs['sheet_query'] = False
                 kwargs['sheet_history'] = True
             else:
+                filename = 'query'
                 kwargs['sheet_query'] = True
                 kwargs['sheet_history'] = True
-            return self._convert_query(req, content, **kwargs)
+        else:
+            return None
+
+        cache = ExcelDownloadCache(self.env)
+        cache_key = None
+        if cache.enabled:
+            cache_key = self._get_cache_key(req, content, key, kwargs)
+        if cache_key:
+            path = cache.get(cache_key, get_excel_format(self.env))
+            if path:
+                return self._send_file(req, path, filename)
+
+        jobs = ExcelDownloadJobModule(self.env)
+        if jobs.enabled:
+            total = content.count(req)
+            if jobs.is_async(total):
+                jobs.submit(req, '%s.%s' % (filename,
+                                            get_excel_format(self.env)),
+                            total, lambda req, book: self._convert_query(
+                                        req, content, book=book, **kwargs))
+
+        book = self._convert_query(req, content, **kwargs)
+        if cache_key:
+            path = cache.store(cache_key, book)
+            return self._send_file(req, path, filename)
+        if is_buffered_download(self.env):
+            return book.dumps(), book.mimetype
+        send_workbook(self.env, req, book,
+                      '%s.%s' % (filename, book.ext))
+
+    def _get_cache_key(self, req, query, key, kwargs):
+        if _has_relative_dates(query):
+            # the tickets are changed as time passes
+            return None
+        query_string = query.to_string()
+        args = ['query', query_string, key, sorted(kwargs.iteritems())]
+        if '$USER' in query_string:
+            args.append(req.authname)
+        args.extend(_get_tickets_freshness(self.env))
+        return ExcelDownloadCache(self.env).get_key(req, *args)
+
+    def _send_file(self, req, path, filename):
+        ext = get_excel_format(self.env)
+        mimetype = get_excel_mimetype(ext)
+        if is_buffered_download(self.env):
+            f = open(path, 'rb')
+            try:
+                return f.read(), mimetype
+            finally:
+                f.close()
+        send_workbook_file(self.env, req, path, mimetype,
+                           '%s.%s' % (filename, ext))
 
     def _convert_query(self, req, query, sheet_query=True,
-                       sheet_history=False):
-        book = get_workbook_writer(self.env, req)
+                       sheet_history=False, book=None):
+        if book is None:
+            book = get_workbook_writer(self.env, req)
 
         # no paginator
+        query = copy.copy(query)
         query.max = 0
         query.has_more_pages = False
         query.offset = 0
@@ -184,56 +626,155 @@ class ExcelTicketModule(Component):
         cols.extend(name for name in ('time', 'changetime')
                          if name not in cols)
         query.cols = cols
+        sql, args = query.get_sql(req)
+        query.num_items = self._count(db, sql, args)
+        cols.extend([name for name in custom_fields if name not in cols])
+        labels = TicketSystem(self.env).get_ticket_field_labels()
+        headers = [{'name': col,
+                    'label': labels.get(col) or dgettext('messages',
+                                                         'Ticket')}
+                   for col in query.get_columns()]
+
+        context = Context.from_request(req, 'query', absurls=True)
+        is_viewable = self._get_viewable_filter(req)
+        formatter = _AuthorFormatter(self.env, req)
+        results = (result for result
+                          in self._execute_query(query, sql, args,
+                                                 custom_fields, db)
+                          if is_viewable(result['id']))
+        batch_size = ExcelDownloadConfig(self.env).fetch_batch_size
+        prefetcher = None
+        if not sheet_history:
+            tkt_ids = None
+        elif sheet_query and self._prefetches_history():
+            # the history is fetched while writing the query sheet
+            prefetcher = tkt_ids = _HistoryPrefetcher(self.env, batch_size)
+        else:
+            tkt_ids = []
 
-        # prevent "SELECT COUNT(*)" query
-        saved_count_prop = query._count
         try:
-            query._count = types.MethodType(lambda self, sql, args, db=None: 0,
-                                            query, query.__class__)
-            if 'db' in inspect.getargspec(query.execute)[0]:
-                tickets = query.execute(req, db)
-            else:
-                tickets = query.execute(req)
-            query.num_items = len(tickets)
+            if sheet_query:
+                self._create_sheet_query(req, context, query, headers,
+                                         results, book, formatter, tkt_ids)
+            elif sheet_history:
+                tkt_ids.extend(result['id'] for result in results)
+            if sheet_history:
+                if prefetcher is not None:
+                    tickets = prefetcher
+                else:
+                    tickets = BulkFetchTicket.iter_select(self.env, tkt_ids,
+                                                          batch_size)
+                self._create_sheet_history(req, context, headers, tickets,
+                                           book, formatter)
         finally:
-            query._count = saved_count_prop
-
-        # add custom fields to avoid error to join many tables
-        self._fill_custom_fields(tickets, query.fields, custom_fields, db)
-
-        context = Context.from_request(req, 'query', absurls=True)
-        cols.extend([name for name in custom_fields if name not in cols])
-        data = query.template_data(context, tickets)
+            if prefetcher is not None:
+                prefetcher.cancel()
+        return book
+
+    def _prefetches_history(self):
+        if not ExcelDownloadConfig(self.env).concurrent_history:
+            return False
+        # the connection of an in-memory database is shared by the threads
+        return not self.env.config.get('trac', 'database') \
+                       .endswith(':memory:')
+
+    def _count(self, db, sql, args):
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM (%s) AS x" % sql, args)
+        return cursor.fetchone()[0]
 
-        if sheet_query:
-            self._create_sheet_query(req, context, data, book)
-        if sheet_history:
-            self._create_sheet_history(req, context, data, book)
-        return book.dumps(), book.mimetype
+    def _execute_query(self, query, sql, args, custom_fields, db):
+        """Generate the results of the query while fetching the rows, with
+        the custom fields fetched for each batch of the rows."""
+        batch_size = max(ExcelDownloadConfig(self.env).fetch_batch_size, 1)
 
-    def _fill_custom_fields(self, tickets, fields, custom_fields, db):
+        cursor = get_server_cursor(self.env, db)
+        try:
+            cursor.execute(sql, args)
+            columns = [desc[0] for desc in cursor.description]
+            for result in self._convert_rows(query, cursor, columns,
+                                             custom_fields, db, batch_size):
+                yield result
+        finally:
+            cursor.close()
+
+    def _convert_rows(self, query, cursor, columns, custom_fields, db,
+                      batch_size):
+        fields = dict((f['name'], f) for f in query.fields)
+        time_fields = set(f['name'] for f in query.fields
+                                  if f['type'] == 'time')
+        col_fields = [fields.get(name) for name in columns]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            results = []
+            for row in rows:
+                result = {}
+                for name, field, val in izip(columns, col_fields, row):
+                    if name == 'reporter':
+                        val = val or 'anonymous'
+                    elif name == 'id':
+                        val = int(val)
+                    elif name in time_fields:
+                        val = from_utimestamp(long(val)) if val else None
+                    elif field and field['type'] == 'checkbox':
+                        val = as_bool(val)
+                    elif val is None:
+                        val = ''
+                    result[name] = val
+                results.append(result)
+            # add custom fields to avoid error to join many tables, without
+            # a temporary table which would reset the cursor
+            self._fill_custom_fields(results, query.fields, custom_fields,
+                                     db, temporary=False)
+            for result in results:
+                yield result
+
+    def _get_viewable_filter(self, req):
+        """Return a function which returns whether the user can view the
+        ticket."""
+        if not has_fine_grained_permissions(self.env):
+            # the permission policies decide without the tickets
+            viewable = 'TICKET_VIEW' in req.perm('ticket')
+            return lambda id: viewable
+        perm = req.perm
+        return lambda id: 'TICKET_VIEW' in perm('ticket', id)
+
+    def _fill_custom_fields(self, tickets, fields, custom_fields, db,
+                            temporary=True):
         if not tickets or not custom_fields:
             return
         fields = dict((f['name'], f) for f in fields)
-        tickets = dict((int(ticket['id']), ticket) for ticket in tickets)
-        query = "SELECT ticket,name,value " \
-                "FROM ticket_custom WHERE %s ORDER BY ticket" % \
-                _tkt_id_conditions('ticket', tickets)
+        tickets = sorted((int(ticket['id']), ticket) for ticket in tickets)
+        id_filter = _TicketIdFilter(self.env,
+                                    [id for id, ticket in tickets],
+                                    temporary)
+        try:
+            self._fetch_custom_fields(db, id_filter, tickets, fields)
+        finally:
+            id_filter.close()
 
+    def _fetch_custom_fields(self, db, id_filter, tickets, fields):
+        """Merge the custom fields into `tickets`, `(id, ticket)` pairs
+        ordered by the id."""
+        checkboxes = set(name for name, f in fields.iteritems()
+                              if f['type'] == 'checkbox')
         cursor = db.cursor()
-        cursor.execute(query)
-        for id, name, value in cursor:
-            if id not in tickets:
-                continue
-            f = fields.get(name)
-            if f and f['type'] == 'checkbox':
-                try:
-                    value = bool(int(value))
-                except (TypeError, ValueError):
-                    value = False
-            tickets[id][name] = value
-
-    def _create_sheet_query(self, req, context, data, book):
+        cursor.execute("SELECT ticket,name,value "
+                       "FROM ticket_custom WHERE %s ORDER BY ticket" %
+                       id_filter('ticket'))
+        for ticket, rows in _merge_join(tickets, cursor):
+            for id, name, value in rows:
+                if name in checkboxes:
+                    try:
+                        value = bool(int(value))
+                    except (TypeError, ValueError):
+                        value = False
+                ticket[name] = value
+
+    def _create_sheet_query(self, req, context, query, headers, results,
+                            book, formatter, tkt_ids):
         def write_headers(writer, query):
             writer.write_row([(
                 u'%s (%s)' % (dgettext('messages', 'Custom Query'),
@@ -241,62 +782,75 @@ class ExcelTicketModule(Component):
                                         '%(num)s matches', query.num_items)),
                 'header', -1, -1)])
 
-        query = data['query']
-        groups = data['groups']
-        fields = data['fields']
-        headers = data['headers']
+        def write_thead(writer):
+            writer.write_row((header['label'], 'thead', None, None)
+                             for idx, header in enumerate(headers))
+
+        names = [header['name'] for header in headers]
+        columns = self._get_columns(names)
+        group = query.group
+        if group:
+            # the results are ordered by the group
+            groups = groupby(results, lambda result: result.get(group))
+            label = dict((f['name'], f['label'])
+                         for f in query.fields).get(group, group)
+        else:
+            groups = [(None, results)]
 
         sheet_count = 1
         sheet_name = dgettext("messages", "Custom Query")
         writer = book.create_sheet(sheet_name)
         write_headers(writer, query)
+        plan = writer.compile_columns(columns)
 
         for groupname, results in groups:
-            results = [result for result in results
-                              if 'TICKET_VIEW' in req.perm(
-                                 context('ticket', result['id']).resource)]
-            if not results:
-                continue
-
-            if writer.row_idx + len(results) + 3 > writer.MAX_ROWS:
-                sheet_count += 1
-                writer = book.create_sheet('%s (%d)' % (sheet_name,
-                                                        sheet_count))
-                write_headers(writer, query)
+            if group:
+                # the rows of the group are kept to write the number
+                results = list(results)
+                if writer.row_idx + len(results) + 3 > writer.MAX_ROWS:
+                    sheet_count += 1
+                    writer = book.create_sheet('%s (%d)' % (sheet_name,
+                                                            sheet_count))
+                    write_headers(writer, query)
 
             if groupname:
                 writer.move_row()
-                cell = fields[query.group]['label'] + ' '
-                if query.group in ('owner', 'reporter'):
-                    cell += Chrome(self.env).format_author(req, groupname)
+                cell = label + ' '
+                if group in ('owner', 'reporter'):
+                    cell += formatter.format_author(groupname)
                 else:
                     cell += groupname
                 cell += ' (%s)' % dngettext('messages', '%(num)s match',
                                             '%(num)s matches', len(results))
                 writer.write_row([(cell, 'header2', -1, -1)])
 
-            writer.write_row((header['label'], 'thead', None, None)
-                             for idx, header in enumerate(headers))
+            write_thead(writer)
 
             for result in results:
-                ticket_context = context('ticket', result['id'])
-                cells = []
-                for idx, header in enumerate(headers):
-                    name = header['name']
-                    value, style, width, line = self._get_cell_data(
-                        name, result.get(name), req, ticket_context, writer)
-                    cells.append((value, style, width, line))
-                writer.write_row(cells)
+                if writer.row_idx + 1 >= writer.MAX_ROWS:
+                    sheet_count += 1
+                    writer = book.create_sheet('%s (%d)' % (sheet_name,
+                                                            sheet_count))
+                    write_headers(writer, query)
+                    write_thead(writer)
+                id = result['id']
+                ticket_context = context('ticket', id)
+                writer.write_values(plan, [
+                    self._get_cell_value(name, result.get(name), formatter,
+                                         ticket_context)
+                    for name in names])
+                if tkt_ids is not None:
+                    tkt_ids.append(id)
 
         writer.set_col_widths()
 
-    def _create_sheet_history(self, req, context, data, book):
+    def _create_sheet_history(self, req, context, headers, tickets, book,
+                              formatter):
         def write_headers(writer, headers):
             writer.write_row((header['label'], 'thead', None, None)
                              for idx, header in enumerate(headers))
 
-        groups = data['groups']
-        headers = [header for header in data['headers']
+        headers = [header for header in headers
                    if header['name'] not in ('id', 'time', 'changetime')]
         headers[0:0] = [
             {'name': 'id', 'label': dgettext("messages", "Ticket")},
@@ -305,97 +859,113 @@ class ExcelTicketModule(Component):
             {'name': 'comment', 'label': dgettext("messages", "Comment")},
         ]
 
+        names = [header['name'] for header in headers]
+        indexes = dict((name, idx) for idx, name in enumerate(names))
+        columns = self._get_columns(names)
+
         sheet_name = dgettext("messages", "Change History")
         sheet_count = 1
         writer = book.create_sheet(sheet_name)
         write_headers(writer, headers)
-
-        tkt_ids = [result['id']
-                   for result in chain(*[results for groupname, results
-                                                 in groups])]
-        tickets = BulkFetchTicket.select(self.env, tkt_ids)
-
-        mod = TicketModule(self.env)
-        for result in chain(*[results for groupname, results in groups]):
-            id = result['id']
-            ticket = tickets[id]
+        plan = writer.compile_columns(columns)
+
+        id_idx = indexes['id']
+        time_idx = indexes['time']
+        author_idx = indexes['author']
+        comment_idx = indexes['comment']
+        format_author = formatter.format_author
+        for ticket in tickets:
+            id = ticket.id
             ticket_context = context('ticket', id)
-            if 'TICKET_VIEW' not in req.perm(ticket_context.resource):
-                continue
+            changes = ticket.changes
             values = ticket.values.copy()
-            changes = []
-
-            for change in mod.grouped_changelog_entries(ticket, None):
-                if change['permanent']:
-                    changes.append(change)
-            for change in reversed(changes):
-                change['values'] = values
-                values = values.copy()
-                for name, field in change['fields'].iteritems():
-                    if name in values:
-                        values[name] = field['old']
-            changes[0:0] = [{'date': ticket.time_created, 'fields': {},
-                             'values': values, 'cnum': None,
-                             'comment': '', 'author': ticket['reporter']}]
-
-            if writer.row_idx + len(changes) >= writer.MAX_ROWS:
+            deltas = self._get_history_deltas(changes, values, indexes)
+
+            if writer.row_idx + len(changes) + 1 >= writer.MAX_ROWS:
                 sheet_count += 1
                 writer = book.create_sheet('%s (%d)' % (sheet_name,
                                                         sheet_count))
                 write_headers(writer, headers)
 
-            for change in changes:
-                cells = []
-                for idx, header in enumerate(headers):
-                    name = header['name']
-                    if name == 'id':
-                        value = id
-                    elif name == 'time':
-                        value = change.get('date', '')
-                    elif name == 'comment':
-                        value = change.get('comment', '')
-                    elif name == 'author':
-                        value = change.get('author', '')
-                        value = Chrome(self.env).format_author(req, value)
-                    else:
-                        value = change['values'].get(name, '')
-                    value, style, width, line = \
-                            self._get_cell_data(name, value, req,
-                                                ticket_context, writer)
-                    if name in change['fields']:
-                        style = '%s:change' % style
-                    cells.append((value, style, width, line))
-                writer.write_row(cells)
+            # the cells of the ticket when created, and the deltas are
+            # applied to the cells for each change
+            row = [self._get_cell_value(name, values.get(name, ''), formatter,
+                                        ticket_context)
+                   if name not in ('id', 'time', 'author', 'comment')
+                   else None
+                   for name in names]
+            row[id_idx] = self._get_cell_value('id', id, formatter,
+                                               ticket_context)
+            row[time_idx] = ticket.time_created
+            row[author_idx] = format_author(ticket['reporter'])
+            row[comment_idx] = ''
+            writer.write_values(plan, row)
+
+            for change, delta in izip(changes, deltas):
+                for idx, name, value in delta:
+                    row[idx] = self._get_cell_value(name, value, formatter,
+                                                    ticket_context)
+                row[time_idx] = change.get('date', '')
+                row[author_idx] = format_author(change.get('author', ''))
+                row[comment_idx] = change.get('comment', '')
+                writer.write_values(plan, row,
+                                    [indexes[name]
+                                     for name in change['fields']
+                                     if name in indexes])
 
         writer.set_col_widths()
 
-    def _get_cell_data(self, name, value, req, context, writer):
+    def _get_history_deltas(self, changes, values, indexes):
+        """Return the values of the columns changed by each change, as
+        lists of `(index, name, value)`. `values` is updated from the
+        current values to the values when the ticket was created."""
+        deltas = []
+        for change in reversed(changes):
+            delta = []
+            for name, old in change['fields'].iteritems():
+                if name in values:
+                    idx = indexes.get(name)
+                    if idx is not None:
+                        delta.append((idx, name, values[name]))
+                    values[name] = old
+            deltas.append(delta)
+        deltas.reverse()
+        return deltas
+
+    def _get_columns(self, names):
+        fields = dict((f['name'], f)
+                      for f in TicketSystem(self.env).get_ticket_fields())
+        columns = []
+        for name in names:
+            type = fields[name]['type'] if name in fields else None
+            if name == 'id':
+                columns.append(('text', 'id'))
+            elif name in ('time', 'changetime') or type == 'time':
+                columns.append(('datetime', '[datetime]'))
+            elif name in ('author', 'comment') or \
+                    type in ('text', 'textarea', 'select', 'radio'):
+                columns.append(('text', name))
+            else:
+                columns.append((None, name))
+        return columns
+
+    def _get_cell_value(self, name, value, formatter, context):
         if name == 'id':
-            url = self.env.abs_href.ticket(value)
-            value = '#%d' % value
-            width = len(value)
-            return value, 'id', width, 1
+            return '#%d' % value
 
         if isinstance(value, datetime):
-            return value, '[datetime]', None, None
+            return value
 
         if value and name in ('reporter', 'owner'):
-            value = Chrome(self.env).format_author(req, value)
-            return value, name, None, None
+            return formatter.format_author(value)
 
         if name == 'cc':
-            value = Chrome(self.env).format_emails(context, value)
-            return value, name, None, None
-
-        if name == 'milestone':
-            if value:
-                url = self.env.abs_href.milestone(value)
-                width, line = writer.get_metrics(value)
-                return value, name, width, line
-            else:
-                return '', name, None, None
+            return formatter.format_emails(context, value)
 
-        return value, name, None, None
+        if name == 'milestone' and not value:
+            return ''
+
+        return value
 
 
 class ExcelReportModule(Component):
@@ -409,6 +979,14 @@ class ExcelReportModule(Component):
                 and req.args.get('format') in ('xlsx', 'xls') \
                 and handler.__class__.__name__ == 'ReportModule':
             req.args['max'] = 0
+            if ExcelDownloadCache(self.env).enabled:
+                self._send_cached_report(req)
+            if ExcelDownloadConfig(self.env).report_mode == 'direct':
+                self._send_direct_report(req)
+            elif ExcelDownloadJobModule(self.env).enabled:
+                # the large report is written from the cursor in background
+                # rather than rendered in the request
+                self._send_direct_report(req, async_only=True)
         return handler
 
     def post_process_request(self, req, template, data, content_type):
@@ -424,90 +1002,315 @@ class ExcelReportModule(Component):
         return template, data, content_type
 
     def _convert_report(self, format, req, data):
+        filename = 'report_%s.%s' % (req.args['id'], format)
+        self._send_report(req, filename, data['numrows'],
+                          lambda req, book: self._create_sheet_report(
+                              req, data, book))
+
+    def _send_report(self, req, filename, numrows, build):
+        jobs = ExcelDownloadJobModule(self.env)
+        if jobs.is_async(numrows):
+            jobs.submit(req, filename, numrows, build)
+
         book = get_workbook_writer(self.env, req)
+        build(req, book)
+        cache_key = req.environ.get('tracexceldownload.cache_key')
+        if cache_key:
+            path = ExcelDownloadCache(self.env).store(cache_key, book)
+            send_workbook_file(self.env, req, path, book.mimetype, filename)
+        send_workbook(self.env, req, book, filename)
+
+    def _create_sheet_report(self, req, data, book):
         writer = book.create_sheet(dgettext('messages', 'Report'))
+        header_groups = data['header_groups']
+        cols, plans = self._write_report_title(writer, data['title'],
+                                               data['numrows'], header_groups)
+
+        for value_for_group, row_group in data['row_groups']:
+            rows = ([[cell['value'] for cell in cell_group
+                                    if not cell['header']['hidden']]
+                     for cell_group in row['cell_groups']]
+                    for row in row_group)
+            self._write_report_rows(writer, header_groups, cols, plans,
+                                    value_for_group, len(row_group), rows)
+
+        writer.set_col_widths()
 
+    def _write_report_title(self, writer, title, numrows, header_groups):
         writer.write_row([(
-            '%s (%s)' % (data['title'],
+            '%s (%s)' % (title,
                          dngettext('messages', '%(num)s match',
-                                   '%(num)s matches', data['numrows'])),
+                                   '%(num)s matches', numrows)),
             'header', -1, -1)])
 
-        for value_for_group, row_group in data['row_groups']:
-            writer.move_row()
-
-            if value_for_group and len(row_group):
-                writer.write_row([(
-                    '%s (%s)' % (value_for_group,
-                                 dngettext('messages', '%(num)s match',
-                                           '%(num)s matches', len(row_group))),
-                    'header2', -1, -1)])
-            for header_group in data['header_groups']:
-                writer.write_row([
-                    (header['title'], 'thead', None, None)
-                    for header in header_group
-                    if not header['hidden']])
-
-            for row in row_group:
-                for cell_group in row['cell_groups']:
-                    cells = []
-                    for cell in cell_group:
-                        cell_header = cell['header']
-                        if cell_header['hidden']:
-                            continue
-                        col = cell_header['col'].strip('_').lower()
-                        value, style, width, line = \
-                            self._get_cell_data(req, col, cell, row, writer)
-                        cells.append((value, style, width, line))
-                    writer.write_row(cells)
+        cols = [[header['col'].strip('_').lower() for header in header_group
+                 if not header['hidden']]
+                for header_group in header_groups]
+        plans = [writer.compile_columns([self._get_column(col)
+                                         for col in group_cols])
+                 for group_cols in cols]
+        return cols, plans
 
-        writer.set_col_widths()
+    def _write_report_rows(self, writer, header_groups, cols, plans,
+                           value_for_group, count, rows):
+        writer.move_row()
 
-        content = book.dumps()
-        req.send_response(200)
-        req.send_header('Content-Type', book.mimetype)
-        req.send_header('Content-Length', len(content))
-        req.send_header('Content-Disposition',
-                        'filename=report_%s.%s' % (req.args['id'], format))
-        req.end_headers()
-        req.write(content)
-        raise RequestDone
+        if value_for_group and count:
+            writer.write_row([(
+                '%s (%s)' % (value_for_group,
+                             dngettext('messages', '%(num)s match',
+                                       '%(num)s matches', count)),
+                'header2', -1, -1)])
+        for header_group in header_groups:
+            writer.write_row([
+                (header['title'], 'thead', None, None)
+                for header in header_group
+                if not header['hidden']])
+
+        for row in rows:
+            for idx, values in enumerate(row):
+                writer.write_values(plans[idx], [
+                    self._get_cell_value(col, value)
+                    for col, value in izip(cols[idx], values)])
+
+    def _send_direct_report(self, req, async_only=False):
+        """Send the report written from the cursor without the rendering
+        by `ReportModule`. Return without sending if the report should be
+        rendered, or if `async_only` is `True` and the report is not large
+        enough to be generated in background."""
+        if req.args.get('sort'):
+            # the rows are sorted in Python by `ReportModule`
+            return
+        id = int(req.args['id'])
+        db = _get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute("SELECT title,query FROM report WHERE id=%s", (id,))
+        row = cursor.fetchone()
+        if not row:
+            return
+        title, sql = row
+        query = ''.join(line.strip() for line in (sql or '').splitlines())
+        if not query or query.startswith(('?', 'query:')):
+            # redirected to the query module, or an error
+            return
+        req.perm(Resource('report', id)).require('REPORT_VIEW')
 
-    def _get_cell_data(self, req, col, cell, row, writer):
-        value = cell['value']
+        report_mod = ReportModule(self.env)
+        try:
+            args = report_mod.get_var_args(req)
+        except ValueError:
+            return
+        title = '{%i} %s' % (id, sub_vars(title, args))
+        sql, args = report_mod.sql_sub_vars(sql, args)[:2]
+        sql = sql.replace('@SORT_COLUMN@', '1').replace('@LIMIT_OFFSET@', '')
+        try:
+            cursor.execute("SELECT COUNT(*) FROM (\n%s\n) AS tab" % sql,
+                           args)
+        except Exception:
+            # the error is reported by `ReportModule`
+            return
+        numrows = cursor.fetchone()[0]
+        if async_only and \
+                not ExcelDownloadJobModule(self.env).is_async(numrows):
+            return
 
-        if col == 'report':
-            url = self.env.abs_href.report(value)
-            width, line = writer.get_metrics(value)
-            return value, col, width, line
+        filename = 'report_%s.%s' % (id, req.args['format'])
+        self._send_report(req, filename, numrows,
+                          lambda req, book: self._create_sheet_direct_report(
+                              req, id, title, sql, args, numrows, book))
 
-        if col in ('ticket', 'id'):
-            id_value = cell['value']
-            value = '#%s' % id_value
-            url = get_resource_url(self.env, row['resource'], self.env.abs_href)
-            width = len(value)
-            return id_value, 'id', width, 1
+    def _create_sheet_direct_report(self, req, id, title, sql, args, numrows,
+                                    book):
+        db = _get_db(self.env)
+        cursor = get_server_cursor(self.env, db)
+        try:
+            self._write_direct_report(req, id, title, sql, args, numrows,
+                                      book, cursor)
+        finally:
+            cursor.close()
 
-        if col == 'milestone':
-            url = self.env.abs_href.milestone(value)
-            width, line = writer.get_metrics(value)
-            return value, col, width, line
+    def _write_direct_report(self, req, id, title, sql, args, numrows, book,
+                             cursor):
+        cursor.execute(sql, args)
+        names = [to_unicode(desc[0]) for desc in cursor.description]
+        header_groups = self._get_header_groups(names)
+
+        writer = book.create_sheet(dgettext('messages', 'Report'))
+        cols, plans = self._write_report_title(writer, title, numrows,
+                                               header_groups)
+        visible = [[header['index'] for header in header_group
+                                    if not header['hidden']]
+                   for header_group in header_groups]
+        rows = self._iter_report_rows(req, id, names, cursor)
+
+        if '__group__' in names:
+            # a group starts when the value of __group__ is changed, and
+            # includes the rows which the user cannot view
+            group_idx = names.index('__group__')
+            formatter = _AuthorFormatter(self.env, req)
+            groups = groupby(rows, lambda (row, viewable):
+                                   _report_cell_value(row[group_idx]))
+            for value_for_group, group_rows in groups:
+                # the rows are kept to write the number of the rows
+                group_rows = [[[row[idx] for idx in idxs]
+                               for idxs in visible]
+                              for row, viewable in group_rows if viewable]
+                self._write_report_rows(
+                    writer, header_groups, cols, plans,
+                    value_for_group and
+                    formatter.format_author(value_for_group),
+                    len(group_rows), group_rows)
+        else:
+            rows = ([[row[idx] for idx in idxs] for idxs in visible]
+                    for row, viewable in rows if viewable)
+            first = next(rows, None)
+            if first is not None:
+                self._write_report_rows(writer, header_groups, cols, plans,
+                                        None, None, chain([first], rows))
+
+        writer.set_col_widths()
 
+    def _get_header_groups(self, cols):
+        """Return the header groups of the report columns, according to
+        the naming conventions like `ReportModule`."""
+        labels = TicketSystem(self.env).get_ticket_field_labels()
+        header_groups = [[]]
+        for idx, col in enumerate(cols):
+            header = {'col': col, 'index': idx, 'hidden': False,
+                      'title': labels.get(col) or
+                               col.strip('_').capitalize()}
+            header_group = header_groups[-1]
+            if col.startswith('__') and col.endswith('__'):  # __col__
+                header['hidden'] = True
+            elif col[0] == '_' and col[-1] == '_':           # _col_
+                header_group = []
+                header_groups.append(header_group)
+                header_groups.append([])
+            elif col[0] == '_':                              # _col
+                header['hidden'] = True
+            elif col[-1] == '_':                             # col_
+                header_groups.append([])
+            header_group.append(header)
+        return header_groups
+
+    def _iter_report_rows(self, req, id, cols, cursor):
+        """Generate `(row, viewable)` pairs of the values of the rows from
+        the cursor, with the email addresses formatted if the user can view
+        the row."""
+        id_idx = realm_idx = parent_realm_idx = parent_id_idx = None
+        email_idxs = []
+        for idx, col in enumerate(cols):
+            if col in ('report', 'ticket', 'id', '_id'):
+                id_idx = idx
+            col = col.strip('_')
+            if col in ('reporter', 'cc', 'owner'):
+                email_idxs.append(idx)
+            elif col == 'realm':
+                realm_idx = idx
+            elif col == 'parent_realm':
+                parent_realm_idx = idx
+            elif col == 'parent_id':
+                parent_id_idx = idx
+
+        context = Context.from_request(req, Resource('report', id),
+                                       absurls=True)
+        formatter = _AuthorFormatter(self.env, req)
+        fine_grained = has_fine_grained_permissions(self.env)
+        viewable = {}
+        for row in cursor:
+            row = [_report_value(value) for value in row]
+            realm = 'ticket' if realm_idx is None else \
+                    _report_cell_value(row[realm_idx])
+            parent_realm = '' if parent_realm_idx is None else \
+                           _report_cell_value(row[parent_realm_idx])
+            tkt_id = None if id_idx is None else \
+                     _report_cell_value(row[id_idx])
+            if parent_realm:
+                parent_id = '' if parent_id_idx is None else \
+                            _report_cell_value(row[parent_id_idx])
+                resource = Resource(realm, tkt_id,
+                                    parent=Resource(parent_realm, parent_id))
+            else:
+                resource = Resource(realm, tkt_id)
+            if fine_grained:
+                allowed = realm.upper() + '_VIEW' in req.perm(resource)
+            else:
+                # the permission policies decide without the resources
+                allowed = viewable.get(realm)
+                if allowed is None:
+                    allowed = realm.upper() + '_VIEW' in req.perm(resource)
+                    viewable[realm] = allowed
+            if allowed:
+                for idx in email_idxs:
+                    row[idx] = formatter.format_emails(
+                        context.child(resource), _report_cell_value(row[idx]))
+            yield row, allowed
+
+    def _send_cached_report(self, req):
+        id = req.args.get('id')
+        cache_key = self._get_cache_key(req)
+        if not cache_key:
+            return
+        # the key is computed before the report is executed, in order to
+        # not store the file generated from the older tickets with the key
+        req.environ['tracexceldownload.cache_key'] = cache_key
+        cache = ExcelDownloadCache(self.env)
+        ext = get_excel_format(self.env)
+        path = cache.get(cache_key, ext)
+        if path:
+            req.perm(Resource('report', id)).require('REPORT_VIEW')
+            send_workbook_file(self.env, req, path, get_excel_mimetype(ext),
+                               'report_%s.%s' % (id, req.args['format']))
+
+    def _get_cache_key(self, req):
+        id = req.args.get('id')
+        db = _get_db(self.env)
+        cursor = db.cursor()
+        cursor.execute("SELECT title,query,description FROM report "
+                       "WHERE id=%s", (int(id),))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        title, sql, description = row
+        tokens = _get_sql_tokens(sql or '')
+        if _has_current_time(tokens):
+            # the rows depend on the current time
+            return None
+        freshness = _get_tables_freshness(self.env, _get_sql_tables(tokens))
+        if freshness is None:
+            # the report reads the tables which cannot be checked
+            return None
+        args = dict((name, req.args.get(name)) for name in req.args
+                                               if name.isupper())
+        args.setdefault('USER', req.authname)
+        for name in ('sort', 'asc'):
+            if name in req.args:
+                args[name] = req.args.get(name)
+        args = ['report', id, title, sql, description,
+                sorted(args.iteritems())]
+        args.extend(freshness)
+        return ExcelDownloadCache(self.env).get_key(req, *args)
+
+    def _get_column(self, col):
+        if col in ('ticket', 'id'):
+            return 'number', 'id'
         if col == 'time':
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[time]', None, None
-        elif col in ('date', 'created', 'modified'):
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[date]', None, None
-        elif col == 'datetime':
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[datetime]', None, None
-
-        width, line = writer.get_metrics(value)
-        return value, col, width, line
+            return 'timestamp', '[time]'
+        if col in ('date', 'created', 'modified'):
+            return 'timestamp', '[date]'
+        if col == 'datetime':
+            return 'timestamp', '[datetime]'
+        return None, col
+
+    _time_cols = frozenset(('time', 'date', 'created', 'modified',
+                            'datetime'))
+
+    def _get_cell_value(self, col, value):
+        if col in self._time_cols and \
+                (isinstance(value, (int, long)) or
+                 isinstance(value, basestring) and value.isdigit()):
+            return _to_utimestamp(value)
+        return value
 
     def _add_alternate_links(self, req):
         params = {}